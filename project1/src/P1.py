@@ -7,11 +7,13 @@
 
 from roomba_sim import *
 from roomba_concurrent import *
+from roomba_maps import *
 try:
   import Queue
 except ImportError:
   import queue as Queue
 
+import random
 import time
 
 class aStarRobot(DiscreteRobot):
@@ -40,6 +42,13 @@ class aStarRobot(DiscreteRobot):
   def runRobot(self):
     self.action = self.actionlist.pop()
 
+  def getPlan(self):
+    # actionlist is used from the end
+    return self.actionlist[::-1]
+
+  def planUsed(self, n):
+    del self.actionlist[len(self.actionlist) - n:]
+
   def h(self, node):# Heuristic
     actionList, state = node
     position, dirtList = state
@@ -71,8 +80,7 @@ class aStarRobot(DiscreteRobot):
     west =  (int(x - 1), int(y))
     # Check if cleaning needs to be done
     if position in dirtList:
-      newCleaned = dirtList.copy()
-      newCleaned.remove(position)
+      newCleaned = dirtList - {position}
       stateSu = (position, newCleaned)
       nodeSu = (actionList + ['Suck'], stateSu)
       return [nodeSu]
@@ -119,7 +127,7 @@ class aStarRobot(DiscreteRobot):
     #  as the priority index will implement A*
     frontier = Queue.PriorityQueue()
     frontier.put((self.h(node), node))
-    explored = []
+    explored = set()
     maxexplored = 0
     expansions = 0
     while not frontier.empty():
@@ -130,7 +138,10 @@ class aStarRobot(DiscreteRobot):
         return None
       heurVal, nNode = thisnode
       aList, state = nNode
-      explored.append(self.getHash(nNode))
+      nHash = self.getHash(nNode)
+      if nHash in explored:
+        continue  # Already explored by way of another path
+      explored.add(nHash)
       position, dirt = state
       # Check goal
       if len(dirt) == 0:
@@ -192,49 +203,172 @@ class aStarRobot(DiscreteRobot):
         if maxexplored < len(explored):
           maxexplored = len(explored)
     
+class aStarFleetRobot(aStarRobot):
+  # The aStarRobot for more than one robot in a room.  Instead of every robot
+  # planning to clean all of the dirt, planFleet hands each dirty tile to one
+  # robot and each robot plans for its own share only.  The tiles are handed
+  # out by auction: in each round every robot bids for the dirty tile
+  # nearest the end of its route so far, bidding the length its route would
+  # then be, and the lowest bid wins.  That keeps the longest route, and so
+  # the time to clean the room, short.  Each robot then plans its route one
+  # tile at a time with A*.
+  # Other robots are not planned around, so with robot_collisions a robot
+  # that bumps into one steps aside and plans its route again from there.
+  # A robot whose share is clean heads for the nearest dirt left instead of
+  # waiting, which also keeps it out of the others' way.
+
+  def initialize(self, chromosome):
+    # Planned by planFleet once all robots exist
+    self.actionlist = []
+    self.route = []
+    self.replan = False
+
+  def runRobot(self):
+    if self.percepts[0] == 'Bump':
+      # Walls are planned around, so it was another robot and the plan is
+      # out of step.  A random step keeps two robots meeting head on from
+      # bumping into each other for ever.
+      self.action = random.choice(['North', 'South', 'East', 'West'])
+      self.replan = True
+      return
+    if self.replan or not self.actionlist:
+      self.replan = False
+      dirt = self.getDirty()
+      route = [tile for tile in self.route if tile in dirt]
+      if not route and dirt:
+        # Our share is clean, help with the nearest of the others'
+        x, y = self.getRobotPosition()
+        position = (int(x), int(y))
+        route = [min(dirt, key = lambda tile: (self.distance(position, tile), tile))]
+      self.planRoute(route)
+    if self.actionlist:
+      self.action = self.actionlist.pop()
+    else:
+      self.action = 'Suck'  # The room is clean
+
+  @classmethod
+  def planFleet(cls, robots):
+    for robot, route in zip(robots, cls.shareDirt(robots)):
+      robot.planRoute(route)
+
+  def h(self, node):
+    # aStarRobot's heuristic, plus how far it is at least to the nearest dirt
+    # so the search heads straight for it
+    actionList, state = node
+    position, dirtList = state
+    togo = min([self.distance(position, tile) for tile in dirtList] or [0])
+    return len(dirtList) + (len(actionList) + togo) * 0.1
+
+  @staticmethod
+  def distance(a, b):
+    return abs(a[0] - b[0]) + abs(a[1] - b[1])
+
+  @classmethod
+  def shareDirt(cls, robots):
+    # Returns a list of dirty tiles for each robot, in the order to clean them
+    dirt = set(robots[0].getDirty())
+    ends = []
+    for robot in robots:
+      x, y = robot.getRobotPosition()
+      ends.append((int(x), int(y)))
+    lengths = [0] * len(robots)
+    routes = [[] for robot in robots]
+    # Each robot's current bid (length, tile), only redone when its tile goes
+    bids = [None] * len(robots)
+    while dirt:
+      for i in range(len(robots)):
+        if bids[i] is None or bids[i][1] not in dirt:
+          tile = min(dirt, key = lambda tile: (cls.distance(ends[i], tile), tile))
+          bids[i] = (lengths[i] + cls.distance(ends[i], tile), tile)
+      winner = min(range(len(robots)), key = lambda i: bids[i])
+      length, tile = bids[winner]
+      dirt.discard(tile)
+      routes[winner].append(tile)
+      ends[winner] = tile
+      lengths[winner] = length + 1  # And a step to suck it up
+      bids[winner] = None
+    return routes
+
+  def planRoute(self, route):
+    # A* to each tile of ROUTE in turn, as if it were the only dirt.  Many
+    # small searches are much cheaper than one over a scattered share.
+    x, y = self.getRobotPosition()
+    position = (int(x), int(y))
+    actionList = []
+    for tile in route:
+      leg, state = self.Astar(([], (position, frozenset([tile]))))
+      actionList += leg
+      position = tile
+    actionList.reverse()
+    self.actionlist = actionList
+    self.route = route
+
 ############################################
 ## A few room configurations
 
-allRooms = []
+# Rooms are only built the first time they are used, see roomba_maps.py
+allRooms = RoomCatalog()
+
+@allRooms.room('smallEmptyRoom') # [0]
+def buildSmallEmptyRoom():
+  return RectangularRoom(8,8)
 
-smallEmptyRoom = RectangularRoom(8,8)
-allRooms.append(smallEmptyRoom)  # [0]
+@allRooms.room('smallEmptyRoom2') # [1]
+def buildSmallEmptyRoom2():
+  room = RectangularRoom(8,8)
+  room.setWall( (4,1), (4,5) )
+  return room
 
-smallEmptyRoom2 = RectangularRoom(8,8)
-smallEmptyRoom2.setWall( (4,1), (4,5) )
-allRooms.append(smallEmptyRoom2) # [1]
+@allRooms.room('smallEmptyRoom3') # [2]
+def buildSmallEmptyRoom3():
+  room = RectangularRoom(8,8, 0.5)
+  room.setWall( (4,1), (4,5) )
+  return room
 
-smallEmptyRoom3 = RectangularRoom(8,8, 0.5)
-smallEmptyRoom3.setWall( (4,1), (4,5) )
-allRooms.append(smallEmptyRoom3) # [2]
+@allRooms.room('mediumWalls1Room') # [3]
+def buildMediumWalls1Room():
+  room = RectangularRoom(20,20)
+  room.setWall((5,5), (15,15))
+  return room
 
-mediumWalls1Room = RectangularRoom(20,20)
-mediumWalls1Room.setWall((5,5), (15,15))
-allRooms.append(mediumWalls1Room) # [3]
+@allRooms.room('mediumWalls2Room') # [4]
+def buildMediumWalls2Room():
+  room = RectangularRoom(20,20)
+  room.setWall((5,15), (15,15))
+  room.setWall((5,5), (15,5))
+  return room
 
-mediumWalls2Room = RectangularRoom(20,20)
-mediumWalls2Room.setWall((5,15), (15,15))
-mediumWalls2Room.setWall((5,5), (15,5))
-allRooms.append(mediumWalls2Room) # [4]
+@allRooms.room('mediumWalls3Room') # [5]
+def buildMediumWalls3Room():
+  room = RectangularRoom(15,15, 0.75)
+  room.setWall((3,3), (10,10))
+  room.setWall((3,10), (10,10))
+  room.setWall((10,3), (10,10))
+  return room
 
-mediumWalls3Room = RectangularRoom(15,15, 0.75)
-mediumWalls3Room.setWall((3,3), (10,10))
-mediumWalls3Room.setWall((3,10), (10,10))
-mediumWalls3Room.setWall((10,3), (10,10))
-allRooms.append(mediumWalls3Room) # [5]
+@allRooms.room('mediumWalls4Room') # [6]
+def buildMediumWalls4Room():
+  room = RectangularRoom(30,30, 0.25)
+  room.setWall((7,5), (26,5))
+  room.setWall((26,5), (26,25))
+  room.setWall((26,25), (7,25))
+  return room
 
-mediumWalls4Room = RectangularRoom(30,30, 0.25)
-mediumWalls4Room.setWall((7,5), (26,5))
-mediumWalls4Room.setWall((26,5), (26,25))
-mediumWalls4Room.setWall((26,25), (7,25))
-allRooms.append(mediumWalls4Room) # [6]
+@allRooms.room('mediumWalls5Room') # [7]
+def buildMediumWalls5Room():
+  room = RectangularRoom(30,30, 0.25)
+  room.setWall((7,5), (26,5))
+  room.setWall((26,5), (26,25))
+  room.setWall((26,25), (7,25))
+  room.setWall((7,5), (7,22))
+  return room
 
-mediumWalls5Room = RectangularRoom(30,30, 0.25)
-mediumWalls5Room.setWall((7,5), (26,5))
-mediumWalls5Room.setWall((26,5), (26,25))
-mediumWalls5Room.setWall((26,25), (7,25))
-mediumWalls5Room.setWall((7,5), (7,22))
-allRooms.append(mediumWalls5Room) # [7]
+def __getattr__(name):
+  """ Lets P1.smallEmptyRoom etc. still name the built room. """
+  try:
+    return allRooms[name]
+  except KeyError:
+    raise AttributeError(name)
 
 #############################################    
 def aStar():
@@ -251,3 +385,9 @@ if __name__ == "__main__":
   # Concurrent test execution.
   #concurrent_test(aStarRobot, [allRooms[0], allRooms[1], allRooms[2]], 10)
   #testAllMaps(aStarRobot, [allRooms[0], allRooms[1], allRooms[2]], 2)
+  
+  # Simulation speed on every room
+  #measureStepRate(aStarRobot, allRooms)
+
+  # Four robots sharing the dirt of one room
+  #print(runSimulation(aStarFleetRobot, allRooms[3], num_robots = 4, num_trials = 2))
@@ -6,92 +6,566 @@
 # Python's global interpretter lock.
 
 from roomba_sim import *
-from multiprocessing import Process, Manager
+from roomba_metrics import TileHeatmap
+from multiprocessing import Process
+import multiprocessing
+import multiprocessing.connection
+import os
+import random
 import time
+import traceback
+try:
+  from multiprocessing import resource_tracker, shared_memory
+except ImportError:   # Before Python 3.8
+  shared_memory = None
+
+UNITS_PER_WORKER = 4  # Work units to aim for per worker, so none sits idle long
+STOP_GRACE = 5  # Seconds a worker gets past the deadline to return its unit
+KEEP_ROOMS = 32  # Rooms a SimulationPool keeps besides the current call's
+
+def workerCount():
+    """ Number of processes to run at once: the CPUs this process may use. """
+    try:
+      return len(os.sched_getaffinity(0))
+    except AttributeError:
+      return multiprocessing.cpu_count()
+
+def runUnit(room, num, first, count, options):
+    """ Runs trials FIRST to FIRST + COUNT - 1 of ROOM, room number NUM of a
+    job, with the runSimulation keyword OPTIONS, plus heatmap = True to
+    record a heatmap.  Returns (RunningStats of the trials' scores, the
+    censored ones at their step budget, number of censored trials,
+    QuantileSketch of the scores, heatmap or None), which take the same
+    memory however many trials the unit has. """
+    stats = RunningStats()
+    sketch = QuantileSketch()
+    cut = CensoredCount()
+    options = dict(options)
+    if options.pop('heatmap', False):
+        options['heatmap'] = TileHeatmap.forRoom(room)
+    runSimulation(room = room,
+                  room_number = num,
+                  num_trials = count,
+                  first_trial = first,
+                  stats = stats,
+                  sketch = sketch,
+                  sinks = [cut],
+                  ui_enable = False,
+                  **options)
+    # Trials a deadline kept from starting aren't in stats, but are censored
+    censored = count - (stats.n - cut.n)
+    return (stats, censored, sketch, options.get('heatmap'))
+
+class CensoredCount(object):
+    """ A sink for runSimulation that counts the censored trials. """
+    def __init__(self):
+        self.n = 0
+
+    def write(self, result):
+        if result['censored']:
+            self.n += 1
+
+class SharedGridRoom(GridRoom):
+    """
+    A GridRoom whose tile array lives in shared memory, written once by the
+    process that publishes the room and only read by the workers attached
+    to it.  Tiles a worker cleans are kept in its own set of tile indexes
+    instead, which restoreDirt() empties again after each trial, so every
+    worker sees the published dirt at the start of each trial.  Walls can't
+    be changed.
+    """
+    @classmethod
+    def publish(cls, room):
+        """ Copies ROOM (a GridRoom, or a RectangularRoom which is converted)
+        into a new shared memory block and returns it.  The caller owns the
+        block and should unlink() it when done. """
+        if not isinstance(room, GridRoom):
+          room = GridRoom.fromRoom(room)
+        block = shared_memory.SharedMemory(create = True, size = len(room.tiles))
+        block.buf[:len(room.tiles)] = room.tiles
+        return block
+
+    @classmethod
+    def attach(cls, name, width, height):
+        """ Returns the room published in the shared memory block NAME. """
+        grid = cls.__new__(cls)
+        grid.block = shared_memory.SharedMemory(name = name)
+        grid.width = width
+        grid.height = height
+        grid.stride = width + 2
+        grid.tiles = grid.block.buf[:grid.stride * (height + 2)]
+        counts = bytes(grid.tiles)
+        grid.numTiles = len(counts) - counts.count(TILE_WALL)
+        grid.numDirty = counts.count(TILE_DIRTY)
+        grid.tilesStarting = None
+        grid.cleaned = set()    # Indexes of the dirty tiles cleaned here
+        grid.undoLog = None
+        grid._wallView = None
+        grid._dirtView = None
+        return grid
+
+    def close(self):
+        """ Detaches from the shared memory block. """
+        self.tiles.release()
+        self.block.close()
+
+    def _setTile(self, x, y, state):
+        raise TypeError("A SharedGridRoom can't be changed")
+
+    def cleanTileAtPosition(self, pos):
+        x,y = pos
+        i = self._index(math.floor(x), math.floor(y))
+        if i >= 0 and self.tiles[i] == TILE_DIRTY and i not in self.cleaned:
+          self.cleaned.add(i)
+          self.numDirty -= 1
+          self._dirtView = None
+          if self.undoLog is not None:
+            self.undoLog.append(i)
+
+    def isTileDirty(self, pos):
+        x,y = pos
+        i = self._index(math.floor(x), math.floor(y))
+        if i >= 0 and self.tiles[i] == TILE_DIRTY and i not in self.cleaned:
+          return 'Dirty'
+        return None
+
+    def _tilesOfState(self, state):
+        tiles = bytes(self.tiles)
+        found = set()
+        stride = self.stride
+        i = tiles.find(state)
+        while i >= 0:
+          if state != TILE_DIRTY or i not in self.cleaned:
+            found.add((i % stride - 1, i // stride - 1))
+          i = tiles.find(state, i + 1)
+        return found
+
+    def restoreDirt(self):
+        if self.undoLog:
+          self.cleaned.difference_update(self.undoLog)
+          self.numDirty += len(self.undoLog)
+          self._dirtView = None
+        self.undoLog = None
+#end SharedGridRoom
 
 class SimulationProcess(Process):
     """
-    A process which will run the simulation when started.
+    A worker process of a SimulationPool.  It takes messages from its own
+    INBOX queue until it takes None:
+      ('room', key, room)   keep ROOM, to be used by later units as KEY
+      ('shared', key, name, width, height)
+                            attach to the SharedGridRoom published in the
+                            shared memory block NAME, as room KEY
+      ('drop', key)         forget the room KEY
+      ('run', job, unit, key, num, first, count, options)
+                            run trials FIRST to FIRST + COUNT - 1 in room KEY,
+                            room number NUM of the job, with the runSimulation
+                            keyword OPTIONS
+    and sends (worker number, job, unit) + runUnit's result + (error,) down
+    its own RESULTS pipe for each
+    unit it runs.  Rooms stay in the process
+    between units and between jobs, so each is only sent once.
     """
 
-    def __init__(self, num, dict):
+    def __init__(self, num, inbox, results):
         Process.__init__(self)
         self.num = num
-        self.dict = dict
+        self.inbox = inbox
+        self.results = results
+        self.daemon = True
     #end __init__
 
     def run(self):
-        result = runSimulation(num_robots = 1,
-                               speed = 1,
-                               min_clean = self.min_clean,
-                               num_trials = self.num_trials,
-                               room = self.room,
-                               robot_type = self.robot,
-                               start_location = self.start_location,
-                               chromosome = self.chromosome,
-                               ui_enable = False)
-        self.dict[self.num] = result
+        rooms = {}
+        while True:
+            message = self.inbox.get()
+            if message is None:
+                for room in rooms.values():
+                    if isinstance(room, SharedGridRoom):
+                        room.close()
+                break
+            if message[0] == 'room':
+                rooms[message[1]] = message[2]
+                continue
+            if message[0] == 'shared':
+                try:
+                    rooms[message[1]] = SharedGridRoom.attach(*message[2:])
+                except FileNotFoundError:
+                    pass  # Forgotten before we got to it
+                continue
+            if message[0] == 'drop':
+                room = rooms.pop(message[1], None)
+                if isinstance(room, SharedGridRoom):
+                    room.close()
+                continue
+            (kind, job, unit, key, num, first, count, options) = message
+            try:
+                result = runUnit(rooms[key], num, first, count, options)
+                self.results.send((self.num, job, unit) + result + (None,))
+            except Exception:
+                self.results.send((self.num, job, unit, None, count, None, None,
+                                   traceback.format_exc()))
     #end run
-    
-    def join(self, timeout = None):
-        Process.join(self, timeout)
-    #end join
 #end SimulationProcess
 
-def concurrent_test(robot, rooms, num_trials, start_location = -1, min_clean = 1.0, chromosome = None, timeout = 5*60):
+class SimulationPool(object):
+    """
+    A pool of PROCESSES (default one per CPU) worker processes that stays up
+    between concurrent_test calls, so a tuning or genetic algorithm loop pays
+    for starting processes and sending rooms once rather than every call:
+        with SimulationPool() as pool:
+            for chromosome in population:
+                concurrent_test(robot, rooms, 10, chromosome = chromosome, pool = pool)
+    The workers are forked with everything this process has imported.  A
+    room is sent to every worker the first time it is used and kept there,
+    up to KEEP_ROOMS of them besides the ones the current call uses, the
+    ones used longest ago being dropped first.  Call forget(room) after
+    changing a room that was already used.
+    With shared (the default where Python has multiprocessing.shared_memory)
+    GridRooms and RectangularRooms are published once into shared memory as
+    a SharedGridRoom grid that every worker reads, instead of a pickled copy
+    per worker.  Other rooms, like TiledRooms, are always pickled.
+    """
+
+    def __init__(self, processes = None, shared = True, keep_rooms = KEEP_ROOMS):
+        if processes is None:
+            processes = workerCount()
+        # Each worker sends its results down its own pipe, so killing one
+        # can't leave a shared queue locked or half written
+        self.results = [None] * processes
+        self.workers = [None] * processes
+        self.inboxes = [None] * processes
+        self.shared = shared and shared_memory is not None
+        if self.shared:
+            # Start the tracker that unlinks leaked shared memory now, so the
+            # workers share it rather than each starting its own, which would
+            # unlink the rooms when that worker exits
+            resource_tracker.ensure_running()
+        self.rooms = {}     # key -> room, held so id()s aren't reused
+        self.messages = {}  # key -> message that gives a worker the room
+        self.blocks = {}    # key -> shared memory block of a published room
+        self.keys = {}      # id(room) -> key
+        self.used = {}      # key -> last job that used the room
+        self.keepRooms = keep_rooms
+        self.nextKey = 0
+        self.job = 0
+        for i in range(processes):
+            self._startWorker(i)
+    #end __init__
+
+    def _startWorker(self, i):
+        """ Starts worker I, sending it every room the pool knows. """
+        self.inboxes[i] = multiprocessing.Queue()
+        (self.results[i], sender) = multiprocessing.Pipe(False)
+        self.workers[i] = SimulationProcess(i, self.inboxes[i], sender)
+        self.workers[i].start()
+        sender.close()  # The worker has its own copy
+        for message in self.messages.values():
+            self.inboxes[i].put(message)
+
+    def _restartWorker(self, i):
+        """ Kills worker I, e.g. in the middle of a unit, and starts another. """
+        self.workers[i].terminate()
+        self.workers[i].join()
+        self.results[i].close()
+        self._startWorker(i)
+
+    def _receive(self, busy, timeout):
+        """ Waits up to TIMEOUT seconds (None for no limit) for the next
+        result from a worker and returns it, or None if none came.  A busy
+        worker that died is restarted and reported as a failed unit. """
+        end = None
+        if timeout is not None:
+            end = time.time() + timeout
+        while True:
+            if end is not None:
+                timeout = max(0, end - time.time())
+            ready = multiprocessing.connection.wait(self.results, timeout)
+            if not ready:
+                return None
+            i = self.results.index(ready[0])
+            try:
+                return ready[0].recv()
+            except EOFError:
+                self._restartWorker(i)
+                if i in busy:
+                    return (i, self.job, busy[i], None, 0, None, None,
+                            "Worker process %d exited" % i)
+
+    def __len__(self):
+        return len(self.workers)
+
+    def roomKey(self, room):
+        """ The key ROOM is known by in the workers, sending it if need be. """
+        key = self.keys.get(id(room))
+        if key is None:
+            key = self.nextKey
+            self.nextKey += 1
+            self.keys[id(room)] = key
+            self.rooms[key] = room
+            if self.shared and isinstance(room, (GridRoom, RectangularRoom)) \
+                    and not isinstance(room, TiledRoom):
+                block = SharedGridRoom.publish(room)
+                self.blocks[key] = block
+                message = ('shared', key, block.name, room.getWidth(), room.getHeight())
+            else:
+                message = ('room', key, room)
+            self.messages[key] = message
+            for inbox in self.inboxes:
+                inbox.put(message)
+        return key
+
+    def forget(self, room):
+        """ Drops ROOM from the workers, so it is sent again when next used. """
+        key = self.keys.get(id(room))
+        if key is not None:
+            self._drop(key)
+
+    def _drop(self, key):
+        """ Drops the room known as KEY from the workers and the pool. """
+        room = self.rooms.pop(key)
+        del self.keys[id(room)]
+        del self.messages[key]
+        self.used.pop(key, None)
+        for inbox in self.inboxes:
+            inbox.put(('drop', key))
+        if key in self.blocks:
+            # Workers that still have it mapped keep it until they drop it
+            block = self.blocks.pop(key)
+            block.close()
+            block.unlink()
+
+    def _dropOldRooms(self):
+        """ Drops the rooms used longest ago, but none of the current job's,
+        until no more than keepRooms others are kept. """
+        old = sorted((job, key) for (key, job) in self.used.items() if job != self.job)
+        for (job, key) in old[:max(0, len(old) - self.keepRooms)]:
+            self._drop(key)
+
+    def run(self, rooms, units, timeout = None, progress = None, **options):
+        """
+        Runs the work UNITS (room number, first trial, number of trials) on
+        ROOMS with the runSimulation keyword OPTIONS, plus heatmap = True to
+        record heatmaps.  Returns a list of (room number, first trial,
+        RunningStats of the scores of the trials run, number of censored
+        trials, QuantileSketch of those scores, heatmap), one for every
+        unit, in the order they finished.  With a TIMEOUT in seconds the
+        workers stop the trials they are running when it is up, and the
+        units not started by then are returned with no trials run and all
+        their trials censored.  A worker that hasn't returned its unit STOP_GRACE seconds
+        later, e.g. one stuck in a robot's initialize, is restarted.
+        PROGRESS, if given, is called with the first four of those for each
+        unit as soon as it is in.
+        """
+        self.job += 1
+        keys = [self.roomKey(room) for room in rooms]
+        for key in keys:
+            self.used[key] = self.job
+        self._dropOldRooms()
+        todo = list(reversed(list(enumerate(units))))
+        busy = {}           # worker -> unit it is running
+        idle = list(range(len(self.workers)))
+        done = []
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+            options = dict(options, deadline = deadline)
+        while todo or busy:
+            if deadline is not None and time.time() >= deadline:
+                break
+            while todo and idle:
+                (n, (num, first, count)) = todo.pop()
+                i = idle.pop()
+                busy[i] = n
+                self.inboxes[i].put(('run', self.job, n, keys[num], num, first, count, options))
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.time())
+            result = self._receive(busy, remaining)
+            if result is None:
+                break
+            self._finished(result, busy, idle, units, done, progress)
+        # Out of time: what is running stops by itself, what isn't never starts
+        while busy:
+            remaining = deadline + STOP_GRACE - time.time()
+            result = self._receive(busy, max(0, remaining))
+            if result is None:
+                break
+            self._finished(result, busy, idle, units, done, progress)
+        for i, n in busy.items():
+            self._restartWorker(i)
+            todo.append((n, units[n]))
+        for (n, (num, first, count)) in todo:
+            done.append((num, first, RunningStats(), count, QuantileSketch(), None))
+            if progress is not None:
+                progress(*done[-1][:4])
+        return done
+
+    def _finished(self, result, busy, idle, units, done, progress):
+        """ Records the RESULT of a unit that a worker sent back, raising
+        RuntimeError if it failed. """
+        (i, job, n, stats, censored, sketch, heatmap, error) = result
+        if job != self.job:
+            return  # From a job that was abandoned
+        del busy[i]
+        idle.append(i)
+        (num, first, count) = units[n]
+        if error is not None:
+            for i in busy:
+                self._restartWorker(i)
+            busy.clear()
+            raise RuntimeError("Simulation of room %d failed:\n%s" % (num, error))
+        done.append((num, first, stats, censored, sketch, heatmap))
+        if progress is not None:
+            progress(num, first, stats, censored)
+
+    def close(self):
+        """ Stops the workers and frees the shared rooms. """
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for worker in self.workers:
+            worker.join()
+        for results in self.results:
+            results.close()
+        for block in self.blocks.values():
+            block.close()
+            block.unlink()
+        self.blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+#end SimulationPool
+
+def workUnits(num_rooms, num_trials, workers, chunk_trials = None):
+    """ Splits NUM_TRIALS trials in each of NUM_ROOMS rooms into work units
+    (room number, first trial, number of trials) of CHUNK_TRIALS trials,
+    by default enough units to give each of WORKERS several. """
+    if chunk_trials is None:
+      total = num_rooms * num_trials
+      chunk_trials = max(1, -(-total // (workers * UNITS_PER_WORKER)))
+    chunk_trials = min(chunk_trials, num_trials)
+    units = []
+    for first in range(0, num_trials, chunk_trials):
+      for num in range(num_rooms):
+        units.append((num, first, min(chunk_trials, num_trials - first)))
+    return units
+
+def concurrent_test(robot, rooms, num_trials, start_location = -1, min_clean = 1.0, chromosome = None, timeout = 5*60,
+                    detect_cycles = False, sketches = None, heatmaps = None, seed = None,
+                    processes = None, chunk_trials = None, pool = None,
+                    max_steps = None, trial_time = None, censored = None,
+                    progress = None):
     """
     Run the tests in multiple processes. Can be directly swapped out for testAllMaps.
+    The trials of all rooms are split into work units of chunk_trials trials
+    that a pool of PROCESSES worker processes (default one per CPU) take
+    turns at, so all CPUs are kept busy however many rooms there are.  Pass
+    a SimulationPool as pool to reuse its processes, and the rooms they
+    already have, instead of starting new ones for this call.
+    If a dict is given as sketches, the QuantileSketch of each room's steps is
+    stored in it by room number.  Likewise for a dict given as heatmaps, which
+    turns on recording a roomba_metrics.TileHeatmap for each room.
+    Every trial draws from its own random streams (see runSimulation), so
+    the results are the same as testAllMaps with the same seed, up to
+    rounding in merging the units' statistics, and don't depend on how the
+    work is scheduled.  Without a seed, one is drawn from the random module.
+    Workers send back a RunningStats and a QuantileSketch per unit rather
+    than every trial's score, so memory per room doesn't grow with trials.
+    max_steps and trial_time are runSimulation's budgets for each trial.
+    When the timeout for the whole call is up, the trials running are
+    stopped and no more are started.  Trials stopped by a budget or the
+    timeout, or never started, are censored and scored as their step budget
+    (see stepBudget), so a robot never scores better for being cut off.  The
+    number censored is printed next to the number finished, and stored by
+    room number in censored if it is a dict.
+    progress, if given, is called with (room number, first trial,
+    RunningStats of the scores of the trials run, number of censored
+    trials) as each work unit comes in, e.g. to report on a long run while
+    it goes.
     """
     # Setup variables
+    rooms        = list(rooms)
     num_rooms    = len(rooms)               # Total number of rooms
     total_trials = num_trials * num_rooms   # Total number of trials
-    processes    = []                       # List for all processes
-    manager      = Manager()                # Manager to handle result transfer
-    dict         = manager.dict()           # Dict which will store results
-    
-    # Create a process for each room, storing parameters in instance variables
-    for i, room in enumerate(rooms):
-        process = SimulationProcess(i, dict)
-        process.robot          = robot
-        process.room           = room
-        process.num_trials     = num_trials
-        process.start_location = start_location
-        process.min_clean = min_clean
-        process.chromosome     = chromosome
-        process.start()
-        processes.append(process)
-    #end for
-
-    # Wait for timeout, or whenever everything is done
+    if seed is None:
+        seed = random.getrandbits(32)
     starttime = time.time()
-    alldone = True
-    while time.time() - starttime < timeout:
-      alldone = True
-      for i, process in enumerate(processes):
-        if process.is_alive():
-          alldone = False
-      if alldone:
-        break
-      time.sleep(1)
-    
-    # See if processes need killing
-    if not alldone:
-      print('Timeout of ' + str(timeout) + ' seconds occured, killing processes...')
-      for i, process in enumerate(processes):
-        if process.is_alive():
-          print('  Killed ' + str(i))
-          process.terminate()
-          dict[i] = (99998,0)
-        
+    ownpool = pool is None
+    if ownpool:
+        pool = SimulationPool(min(processes or workerCount(), total_trials))
+    units = workUnits(num_rooms, num_trials, len(pool), chunk_trials)
+    try:
+        finished = pool.run(rooms, units, timeout, progress,
+                            robot_type = robot,
+                            num_robots = 1,
+                            speed = 1,
+                            min_clean = min_clean,
+                            start_location = start_location,
+                            chromosome = chromosome,
+                            detect_cycles = detect_cycles,
+                            heatmap = heatmaps is not None,
+                            seed = seed,
+                            max_steps = max_steps,
+                            trial_time = trial_time)
+    finally:
+        if ownpool:
+            pool.close()
+    if timeout is not None and time.time() - starttime >= timeout:
+      print('Timeout of ' + str(timeout) + ' seconds occured')
+
+    # Gather the units of each room
+    budget   = stepBudget(max_steps)        # Score of a censored trial
+    counts   = dict(((num, first), count) for (num, first, count) in units)
+    summary  = [{} for room in rooms]       # room -> {first trial: (stats, sketch)}
+    cut      = [0] * num_rooms              # room -> censored trials
+    roommaps = [None] * num_rooms
+    for (num, first, unitstats, unitcut, unitsketch, heatmap) in finished:
+      # Trials that never ran count at the budget too
+      for k in range(counts[(num, first)] - unitstats.n):
+        unitstats.add(budget)
+        unitsketch.add(budget)
+      summary[num][first] = (unitstats, unitsketch)
+      cut[num] += unitcut
+      if heatmap is not None:
+        if roommaps[num] is None:
+          roommaps[num] = heatmap
+        else:
+          roommaps[num].merge(heatmap)
+
     # Print the results
     total_score = 0
-    for i, process in enumerate(processes):
-        process.join()
-        (score, std) = dict[i]
-        print("Room %d of %d done (score: %d std: %d)" % (i + 1, num_rooms, score, std))
+    for i in range(num_rooms):
+        # Merge the units in trial order, so the sums don't depend on which
+        # unit came in first
+        stats = RunningStats()
+        sketch = QuantileSketch()
+        for first in sorted(summary[i]):
+          (unitstats, unitsketch) = summary[i][first]
+          stats.merge(unitstats)
+          sketch.merge(unitsketch)
+        (score, std) = stats.meanstdv()
+        if cut[i]:
+          print("Room %d of %d done (score: %d std: %d) with %d of %d trials censored" %
+                (i + 1, num_rooms, score, std, cut[i], num_trials))
+        else:
+          print("Room %d of %d done (score: %d std: %d)" % (i + 1, num_rooms, score, std))
+        print("  " + sketch.summary())
+        if sketches is not None:
+            sketches[i] = sketch
+        if heatmaps is not None:
+            heatmaps[i] = roommaps[i]
+        if censored is not None:
+            censored[i] = cut[i]
         total_score += score
     #end for
-    
-    print("Average score over %d trials: %d" % (total_trials, total_score / num_rooms))
+
+    if sum(cut):
+      print("Average score over %d trials, %d finished and %d censored: %d" %
+            (total_trials, total_trials - sum(cut), sum(cut), total_score / num_rooms))
+    else:
+      print("Average score over %d trials: %d" % (total_trials, total_score / num_rooms))
     return total_score / num_rooms
 #end concurrent_test
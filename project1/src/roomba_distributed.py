@@ -0,0 +1,412 @@
+# roomba_distributed.py
+#
+# This file spreads the work units of concurrent_test over worker processes
+# on other machines, talking over TCP with a multiprocessing.managers
+# server.  The machine running concurrent_test starts a DistributedPool:
+#
+#     with DistributedPool(('0.0.0.0', 6100), authkey = b'secret') as pool:
+#         concurrent_test(aStarRobot, allRooms, 10, pool = pool)
+#
+# and each worker machine runs one process per CPU that connects to it:
+#
+#     ROOMBA_AUTHKEY=secret python3 roomba_distributed.py coordinator:6100
+#
+# Workers need the same code as the coordinator, since robot classes are
+# sent by module and name: robots defined in the script that is run as
+# __main__ can't be found by the workers, so put them in a module.
+# Everything sent is pickled, so only use this on a network you trust, and
+# keep the authkey secret.
+
+from roomba_concurrent import *
+from multiprocessing.managers import BaseManager
+from collections import deque
+import multiprocessing
+import os
+import pickle
+import socket
+import sys
+import threading
+import time
+import traceback
+
+HEARTBEAT_SECONDS = 2    # Time between heartbeats from each worker
+HEARTBEAT_TIMEOUT = 10   # A worker not heard from for this long is lost
+CONNECT_TIMEOUT = 60     # Seconds a worker keeps trying to reach the pool
+
+class PoolClient(BaseManager):
+    """ The workers' end of the connection to a DistributedPool. """
+PoolClient.register('pool')
+
+def authKey(authkey = None):
+    """ AUTHKEY as bytes, by default from the ROOMBA_AUTHKEY environment
+    variable. """
+    if authkey is None:
+        authkey = os.environ.get('ROOMBA_AUTHKEY')
+        if not authkey:
+            raise ValueError("No authkey given and ROOMBA_AUTHKEY isn't set")
+    if not isinstance(authkey, bytes):
+        authkey = authkey.encode('utf-8')
+    return authkey
+
+class PoolState(object):
+    """
+    The units of a DistributedPool's current job and the workers running
+    them.  It lives in the pool's server process, and both the workers and
+    the DistributedPool call its methods through proxies.
+    """
+
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.rooms = {}     # key -> pickled room
+        self.workers = {}   # worker -> name
+        self.seen = {}      # worker -> time.time() last heard from
+        self.nextWorker = 0
+        self.job = 0
+        self.units = []
+        self.options = None
+        self.todo = deque() # units of this job not handed out yet
+        self.leases = {}    # unit -> worker running it
+        self.done = {}      # unit -> True once its result is in
+        self.finished = []  # results of this job in the order they came in
+        self.error = None
+        self.deadline = None
+        self.closing = False
+    #end __init__
+
+    # Called by the DistributedPool
+
+    def addRoom(self, key, data):
+        """ Keeps DATA, a pickled room, for the workers as room KEY. """
+        with self.lock:
+            self.rooms[key] = data
+
+    def dropRoom(self, key):
+        with self.lock:
+            self.rooms.pop(key, None)
+
+    def workerCount(self):
+        with self.lock:
+            return len(self.seen)
+
+    def start(self, units, options, timeout):
+        """ Starts a job of UNITS (room key, room number, first trial, number
+        of trials) with the pickled runSimulation OPTIONS, which must be done
+        within TIMEOUT seconds if that isn't None. """
+        with self.lock:
+            self.job += 1
+            self.units = units
+            self.options = options
+            self.todo = deque(range(len(units)))
+            self.leases = {}
+            self.done = {}
+            self.finished = []
+            self.error = None
+            self.deadline = None
+            if timeout is not None:
+                self.deadline = time.time() + timeout
+            self.lock.notify_all()
+
+    def poll(self, reported, wait):
+        """ Waits up to WAIT seconds for results of the job past the first
+        REPORTED, and returns (those results, True if the job is over).  It
+        is over once every unit is in, or when it is out of time and the
+        units running have come in or had STOP_GRACE seconds more.  Raises
+        RuntimeError if a unit failed. """
+        with self.lock:
+            end = time.time() + wait
+            while True:
+                now = time.time()
+                self._checkWorkers(now)
+                if self.error is not None:
+                    (num, error) = self.error
+                    raise RuntimeError("Simulation of room %d failed:\n%s" % (num, error))
+                over = len(self.done) == len(self.units)
+                remaining = end - now
+                if self.deadline is not None:
+                    if now >= self.deadline and not self.leases:
+                        over = True
+                    if now >= self.deadline + STOP_GRACE:
+                        over = True
+                    if now < self.deadline:
+                        remaining = min(remaining, self.deadline - now)
+                    else:
+                        remaining = min(remaining, self.deadline + STOP_GRACE - now)
+                if over or len(self.finished) > reported or remaining <= 0:
+                    return (self.finished[reported:], over)
+                self.lock.wait(remaining)
+
+    def end(self, reported):
+        """ Ends the job, so anything still out or queued is no longer
+        wanted.  Returns (the results past the first REPORTED, the units
+        that never came in). """
+        with self.lock:
+            self.todo.clear()
+            self.leases = {}
+            self.job += 1
+            missing = [self.units[n][1:] for n in range(len(self.units))
+                       if n not in self.done]
+            return (self.finished[reported:], missing)
+
+    def close(self):
+        """ Tells the workers to stop. """
+        with self.lock:
+            self.closing = True
+            self.lock.notify_all()
+
+    def _checkWorkers(self, now):
+        """ Hands the units of workers not heard from for HEARTBEAT_TIMEOUT
+        seconds to others. """
+        for worker, seen in list(self.seen.items()):
+            if now - seen > HEARTBEAT_TIMEOUT:
+                del self.seen[worker]
+                lost = [n for n, w in self.leases.items() if w == worker]
+                for n in lost:
+                    del self.leases[n]
+                    self.todo.appendleft(n)
+                print("Lost worker %s, requeued %d work units" % (self.workers[worker], len(lost)))
+                self.lock.notify_all()
+
+    # Called by the workers
+
+    def join(self, name):
+        """ Registers a worker called NAME and returns its number. """
+        with self.lock:
+            worker = self.nextWorker
+            self.nextWorker += 1
+            self.workers[worker] = name
+            self.seen[worker] = time.time()
+            return worker
+
+    def heartbeat(self, worker):
+        """ Records that WORKER is still there. """
+        with self.lock:
+            self.seen[worker] = time.time()
+
+    def take(self, worker, wait):
+        """ Hands WORKER a unit to run: (job, unit, room key, room number,
+        first trial, number of trials, pickled options, seconds left or
+        None), waiting up to WAIT seconds for one.  Returns None if there
+        is none, or 'stop' when the pool is closing. """
+        with self.lock:
+            self.seen[worker] = time.time()
+            end = time.time() + wait
+            while not self.closing:
+                if self.todo and (self.deadline is None or time.time() < self.deadline):
+                    n = self.todo.popleft()
+                    self.leases[n] = worker
+                    (key, num, first, count) = self.units[n]
+                    left = None
+                    if self.deadline is not None:
+                        left = self.deadline - time.time()
+                    return (self.job, n, key, num, first, count, self.options, left)
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return None
+                self.lock.wait(remaining)
+            return 'stop'
+
+    def room(self, key):
+        """ The pickled room KEY. """
+        with self.lock:
+            return self.rooms[key]
+
+    def finish(self, worker, job, n, stats, censored, sketch, heatmap, error):
+        """ Records the result of unit N of JOB, run by WORKER. """
+        with self.lock:
+            self.seen[worker] = time.time()
+            if job != self.job or n in self.done:
+                return  # From a job that is over, or run twice after a loss
+            self.leases.pop(n, None)
+            if error is not None:
+                if self.error is None:
+                    self.error = (self.units[n][1], error)
+            else:
+                (key, num, first, count) = self.units[n]
+                self.done[n] = True
+                self.finished.append((num, first, stats, censored, sketch, heatmap))
+            self.lock.notify_all()
+#end PoolState
+
+serverState = None  # The PoolState, in a DistributedPool's server process
+
+def makeServerState():
+    global serverState
+    serverState = PoolState()
+
+def getServerState():
+    return serverState
+
+class PoolServer(BaseManager):
+    """ The server a DistributedPool starts, in a process of its own. """
+PoolServer.register('pool', callable = getServerState,
+                    exposed = ('addRoom', 'dropRoom', 'workerCount', 'start',
+                               'poll', 'end', 'close', 'join', 'heartbeat',
+                               'take', 'room', 'finish'))
+
+class DistributedPool(object):
+    """
+    Works like a SimulationPool, and can be passed to concurrent_test in its
+    place, but the work units are run by workers that connect to ADDRESS
+    over TCP (see runWorker), from this or any other machine.  ADDRESS is
+    on this machine only unless a host such as '0.0.0.0' is given.  Units
+    are handed out as workers ask for them, so faster machines run more.  A
+    worker that hasn't sent a heartbeat for HEARTBEAT_TIMEOUT seconds is
+    taken to be lost and the units it was running are handed to others.
+    Results are the same as with a SimulationPool, with the same seed.
+    The server runs in a process of its own, started now and stopped by
+    close().
+    """
+
+    def __init__(self, address = ('127.0.0.1', 0), authkey = None):
+        self.rooms = {}     # key -> room, held so id()s aren't reused
+        self.keys = {}      # id(room) -> key
+        self.nextKey = 0
+        self.server = PoolServer(address = address, authkey = authKey(authkey))
+        self.server.start(makeServerState)
+        self.address = self.server.address
+        self.state = self.server.pool()
+    #end __init__
+
+    def __len__(self):
+        return max(1, self.state.workerCount())
+
+    def roomKey(self, room):
+        """ The key ROOM is known by, sending it to the server the first time. """
+        key = self.keys.get(id(room))
+        if key is None:
+            key = self.nextKey
+            self.nextKey += 1
+            self.keys[id(room)] = key
+            self.rooms[key] = room
+            self.state.addRoom(key, pickle.dumps(room, pickle.HIGHEST_PROTOCOL))
+        return key
+
+    def forget(self, room):
+        """ Drops ROOM, so it is pickled again when next used. """
+        key = self.keys.pop(id(room), None)
+        if key is not None:
+            del self.rooms[key]
+            self.state.dropRoom(key)
+
+    def run(self, rooms, units, timeout = None, progress = None, **options):
+        """ Same as SimulationPool.run, but on the workers that have joined. """
+        keys = [self.roomKey(room) for room in rooms]
+        self.state.start([(keys[num], num, first, count) for (num, first, count) in units],
+                         pickle.dumps(options, pickle.HIGHEST_PROTOCOL), timeout)
+        done = []
+        try:
+            over = False
+            while not over:
+                (results, over) = self.state.poll(len(done), HEARTBEAT_SECONDS)
+                for result in results:
+                    done.append(result)
+                    if progress is not None:
+                        progress(*result[:4])
+        finally:
+            (results, missing) = self.state.end(len(done))
+        for (num, first, count) in missing:
+            results.append((num, first, RunningStats(), count, QuantileSketch(), None))
+        for result in results:
+            done.append(result)
+            if progress is not None:
+                progress(*result[:4])
+        return done
+
+    def close(self):
+        """ Tells the workers to stop, then stops the server. """
+        try:
+            self.state.close()
+        finally:
+            self.server.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+#end DistributedPool
+
+def connectPool(address, authkey = None, timeout = CONNECT_TIMEOUT):
+    """ Returns a proxy for the DistributedPool at ADDRESS, trying for
+    TIMEOUT seconds in case it hasn't started yet. """
+    end = time.time() + timeout
+    while True:
+        client = PoolClient(address = address, authkey = authKey(authkey))
+        try:
+            client.connect()
+            return client.pool()
+        except (EOFError, OSError):
+            if time.time() >= end:
+                raise
+            time.sleep(HEARTBEAT_SECONDS)
+
+def sendHeartbeats(address, authkey, worker, stop):
+    """ Sends a heartbeat for WORKER every HEARTBEAT_SECONDS until STOP (a
+    threading.Event) is set, over its own connection. """
+    try:
+        pool = connectPool(address, authkey, 0)
+        while not stop.wait(HEARTBEAT_SECONDS):
+            pool.heartbeat(worker)
+    except (EOFError, OSError):
+        pass  # The pool has gone, runWorker will find out too
+
+def runWorker(address, authkey = None, name = None):
+    """ Runs work units from the DistributedPool at ADDRESS until it closes
+    or can't be reached.  Rooms are fetched the first time a unit needs
+    them and kept. """
+    if name is None:
+        name = '%s:%d' % (socket.gethostname(), os.getpid())
+    pool = connectPool(address, authkey)
+    worker = pool.join(name)
+    stop = threading.Event()
+    beats = threading.Thread(target = sendHeartbeats, args = (address, authkey, worker, stop))
+    beats.daemon = True
+    beats.start()
+    rooms = {}
+    try:
+        while True:
+            unit = pool.take(worker, HEARTBEAT_SECONDS)
+            if unit is None:
+                continue
+            if unit == 'stop':
+                break
+            (job, n, key, num, first, count, options, left) = unit
+            data = None
+            if key not in rooms:
+                data = pool.room(key)
+            try:
+                if data is not None:
+                    rooms[key] = pickle.loads(data)
+                options = pickle.loads(options)
+                if left is not None:
+                    options['deadline'] = time.time() + left
+                result = runUnit(rooms[key], num, first, count, options) + (None,)
+            except Exception:
+                result = (None, count, None, None, traceback.format_exc())
+            pool.finish(worker, job, n, *result)
+    except (EOFError, OSError):
+        pass  # The pool has gone
+    finally:
+        stop.set()
+
+def startWorkers(address, authkey = None, processes = None):
+    """ Runs PROCESSES (default one per CPU) runWorker processes and waits
+    for them to finish. """
+    if processes is None:
+        processes = workerCount()
+    workers = [multiprocessing.Process(target = runWorker, args = (address, authkey))
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+if __name__ == "__main__":
+    # python3 roomba_distributed.py HOST:PORT [PROCESSES], with the authkey
+    # in ROOMBA_AUTHKEY
+    if len(sys.argv) not in (2, 3):
+        print("Usage: %s HOST:PORT [PROCESSES]" % sys.argv[0])
+        sys.exit(1)
+    host, port = sys.argv[1].rsplit(':', 1)
+    startWorkers((host, int(port)), None,
+                 int(sys.argv[2]) if len(sys.argv) == 3 else None)
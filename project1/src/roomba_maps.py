@@ -0,0 +1,179 @@
+# roomba_maps.py
+#
+# This file provides a text format for room maps, a compiled binary form of
+# those maps cached on disk, and RoomCatalog, a list of named rooms that are
+# only built the first time they are used.
+#
+# A map file has one line per row of the room, the top line being the row
+# with the largest y.  Each character is one tile:
+#   '#'  wall
+#   '*'  dirty floor
+#   '.'  clean floor
+# Blank lines and lines starting with ';' are ignored.  The walls around the
+# edge of the room are implied and should not be drawn.
+
+import hashlib
+import os
+import struct
+
+from roomba_sim import *
+
+MAP_TILES = {'#': TILE_WALL, '*': TILE_DIRTY, '.': TILE_CLEAN}
+MAP_CHARS = dict((v, k) for (k, v) in MAP_TILES.items())
+
+MAP_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'roomba_sim')
+COMPILED_MAGIC = b'RMAP'
+COMPILED_VERSION = 1
+COMPILED_HEADER = struct.Struct('<4sBII')  # magic, version, width, height
+
+
+def parseMap(text):
+    """ Returns a GridRoom built from the map TEXT. """
+    rows = [line.rstrip('\r\n') for line in text.splitlines()]
+    rows = [row for row in rows if row.strip() and not row.startswith(';')]
+    if not rows:
+      raise ValueError("Map has no rows")
+    width = len(rows[0])
+    height = len(rows)
+    room = GridRoom(width, height, 0.0)
+    tiles = room.tiles
+    for n, row in enumerate(rows):
+      if len(row) != width:
+        raise ValueError("Map row %d is %d tiles wide, expected %d" % (n + 1, len(row), width))
+      y = height - 1 - n
+      for x, c in enumerate(row):
+        if c not in MAP_TILES:
+          raise ValueError("Unknown map tile %r in row %d" % (c, n + 1))
+        tiles[room._index(x, y)] = MAP_TILES[c]
+    return GridRoom.fromTiles(width, height, tiles)
+
+
+def formatMap(room):
+    """ Returns the map text for ROOM, a RectangularRoom or GridRoom. """
+    lines = []
+    for y in range(room.getHeight() - 1, -1, -1):
+      row = []
+      for x in range(room.getWidth()):
+        if room.isTileOccupied((x, y)):
+          row.append(MAP_CHARS[TILE_WALL])
+        elif room.isTileDirty((x, y)):
+          row.append(MAP_CHARS[TILE_DIRTY])
+        else:
+          row.append(MAP_CHARS[TILE_CLEAN])
+      lines.append(''.join(row))
+    return '\n'.join(lines) + '\n'
+
+
+def saveMap(room, path):
+    """ Writes ROOM to PATH in the map text format. """
+    with open(path, 'w') as f:
+      f.write(formatMap(room))
+
+
+def compileMap(room):
+    """ Returns the compiled (binary) form of a GridRoom. """
+    return (COMPILED_HEADER.pack(COMPILED_MAGIC, COMPILED_VERSION,
+                                 room.getWidth(), room.getHeight())
+            + bytes(room.tiles))
+
+
+def loadCompiled(data):
+    """ Returns the GridRoom stored in DATA, as made by compileMap(). """
+    magic, version, width, height = COMPILED_HEADER.unpack_from(data)
+    if magic != COMPILED_MAGIC or version != COMPILED_VERSION:
+      raise ValueError("Not a compiled map")
+    return GridRoom.fromTiles(width, height,
+                              memoryview(data)[COMPILED_HEADER.size:])
+
+
+def loadMap(path, cache_dir = None):
+    """
+    Returns the GridRoom described by the map file at PATH.
+    The compiled map is cached in CACHE_DIR (default MAP_CACHE_DIR) under the
+    hash of the map text, so loading an unchanged map again is one read of
+    the compiled file.  Pass cache_dir = False to skip the cache.
+    """
+    with open(path, 'rb') as f:
+      text = f.read()
+    if cache_dir is False:
+      return parseMap(text.decode('ascii'))
+    if cache_dir is None:
+      cache_dir = MAP_CACHE_DIR
+    key = hashlib.sha1(text).hexdigest()
+    cached = os.path.join(cache_dir, '%s.v%d.rmap' % (key, COMPILED_VERSION))
+    try:
+      with open(cached, 'rb') as f:
+        return loadCompiled(f.read())
+    except (IOError, OSError, ValueError, struct.error):
+      pass
+    room = parseMap(text.decode('ascii'))
+    try:
+      if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+      # Write then rename, so other processes never read half a file
+      tmp = '%s.%d.tmp' % (cached, os.getpid())
+      with open(tmp, 'wb') as f:
+        f.write(compileMap(room))
+      os.rename(tmp, cached)
+    except (IOError, OSError):
+      pass  # The cache is only an optimization
+    return room
+
+
+class RoomCatalog(object):
+    """
+    A list of named rooms where each room is only built the first time it is
+    used.  Rooms are added with a function that builds them, or a map file,
+    and can be looked up by position or by name.  Iterating builds every room.
+    """
+    def __init__(self):
+      self.names = []
+      self.builders = {}
+      self.rooms = {}
+
+    def add(self, name, builder):
+      """ Adds a room called NAME that is built by calling BUILDER(). """
+      if name in self.builders:
+        raise ValueError("Room already in catalog: " + name)
+      self.names.append(name)
+      self.builders[name] = builder
+
+    def addMap(self, name, path, cache_dir = None):
+      """ Adds a room called NAME loaded from the map file at PATH. """
+      self.add(name, lambda: loadMap(path, cache_dir))
+
+    def room(self, name):
+      """ Decorator version of add(). """
+      def register(builder):
+        self.add(name, builder)
+        return builder
+      return register
+
+    def isBuilt(self, name):
+      """ True if the room NAME has already been built. """
+      return name in self.rooms
+
+    def __getitem__(self, key):
+      if isinstance(key, slice):
+        return [self[name] for name in self.names[key]]
+      if not isinstance(key, str):
+        key = self.names[key]
+      if key not in self.rooms:
+        if key not in self.builders:
+          raise KeyError(key)
+        self.rooms[key] = self.builders[key]()
+      return self.rooms[key]
+
+    def __len__(self):
+      return len(self.names)
+
+    def __iter__(self):
+      for name in self.names:
+        yield self[name]
+
+    def index(self, room):
+      """ Position of an already built ROOM, like list.index(). """
+      for i, name in enumerate(self.names):
+        if self.rooms.get(name) is room:
+          return i
+      raise ValueError("Room not in catalog")
@@ -0,0 +1,290 @@
+# roomba_metrics.py
+#
+# This file provides sinks for the per-trial results produced by
+# iterSimulation.  Pass them to runSimulation(sinks = [...]) or call write()
+# yourself.  Each result is written out as soon as its trial finishes, so long
+# sweeps don't have to hold their results in memory.
+#
+# It also provides TileHeatmap, per tile counters that runSimulation fills in
+# when asked to, and PhaseProfiler, which times the parts of a simulation step.
+
+import json
+import math
+import time
+import zipfile
+from array import array
+
+
+class JsonlSink(object):
+    """
+    Writes each trial result as one line of JSON, flushed straight away so
+    the file can be read while the simulation is still running.  Any keyword
+    arguments are added to every line, e.g. JsonlSink('out.jsonl', room = 3).
+    """
+    def __init__(self, path, append = False, **extra):
+      self.f = open(path, 'a' if append else 'w')
+      self.extra = extra
+
+    def write(self, result):
+      record = dict(self.extra)
+      record.update(result)
+      self.f.write(json.dumps(record) + '\n')
+      self.f.flush()
+
+    def close(self):
+      self.f.close()
+
+    def __enter__(self):
+      return self
+
+    def __exit__(self, *exc):
+      self.close()
+
+
+class NpzSink(object):
+    """
+    Writes trial results to a compressed NumPy archive that numpy.load() can
+    read once the sink is closed.  Each trial's clean fraction curve is added
+    to the archive as it arrives, as '<prefix>clean_<trial>', and the steps,
+    done and bumps of all trials are added as '<prefix>steps', '<prefix>done'
+    and '<prefix>bumps' on close.  Needs NumPy, which is only imported here
+    so the simulation workers that use this module don't load it.
+    """
+    def __init__(self, path, prefix = ''):
+      try:
+        import numpy
+      except ImportError:
+        raise ImportError("NpzSink needs NumPy")
+      self.numpy = numpy
+      self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64 = True)
+      self.prefix = prefix
+      self.steps = []
+      self.done = []
+      self.bumps = []
+
+    def _writeArray(self, name, array):
+      with self.zip.open(self.prefix + name + '.npy', 'w', force_zip64 = True) as f:
+        numpy = self.numpy
+        numpy.lib.format.write_array(f, numpy.asarray(array), allow_pickle = False)
+
+    def write(self, result):
+      self._writeArray('clean_%d' % result['trial'], result['clean'])
+      self.steps.append(result['steps'])
+      self.done.append(result['done'])
+      self.bumps.append(result['bumps'])
+
+    def close(self):
+      numpy = self.numpy
+      self._writeArray('steps', numpy.array(self.steps, dtype = numpy.int32))
+      self._writeArray('done', numpy.array(self.done, dtype = bool))
+      self._writeArray('bumps', numpy.array(self.bumps, dtype = numpy.int32))
+      self.zip.close()
+
+    def __enter__(self):
+      return self
+
+    def __exit__(self, *exc):
+      self.close()
+
+
+class TileHeatmap(object):
+    """
+    Per tile counters for a room of a given size, summed over trials:
+    how many time steps a robot spent on each tile, and the sum and count of
+    the time step each tile was first cleaned at.  Pass one to
+    runSimulation(heatmap = ...) and merge() heatmaps from other processes.
+    Tile (x,y) is at index y * width + x of each array.
+    """
+    def __init__(self, width, height):
+      self.width = width
+      self.height = height
+      self.trials = 0
+      self.visits = array('L', bytes(array('L').itemsize * width * height))
+      self.cleanTimes = array('d', bytes(array('d').itemsize * width * height))
+      self.cleanCounts = array('L', bytes(array('L').itemsize * width * height))
+
+    @classmethod
+    def forRoom(cls, room):
+      """ Returns an empty heatmap the size of ROOM. """
+      return cls(room.getWidth(), room.getHeight())
+
+    def _index(self, pos):
+      """ Index of the tile under POS, or -1 if outside the room. """
+      x, y = pos
+      x = math.floor(x)
+      y = math.floor(y)
+      if x < 0 or x >= self.width or y < 0 or y >= self.height:
+        return -1
+      return y * self.width + x
+
+    def visit(self, pos):
+      """ Counts one time step spent at POS. """
+      i = self._index(pos)
+      if i >= 0:
+        self.visits[i] += 1
+
+    def cleaned(self, pos, time):
+      """ Records that the tile at POS was cleaned at time step TIME. """
+      i = self._index(pos)
+      if i >= 0:
+        self.cleanTimes[i] += time
+        self.cleanCounts[i] += 1
+
+    def endTrial(self):
+      """ Called once at the end of every trial. """
+      self.trials += 1
+
+    def merge(self, other):
+      """ Adds the counters of another heatmap of the same size. """
+      if (other.width, other.height) != (self.width, self.height):
+        raise ValueError("Can only merge heatmaps of the same size")
+      for i in range(len(self.visits)):
+        self.visits[i] += other.visits[i]
+        self.cleanTimes[i] += other.cleanTimes[i]
+        self.cleanCounts[i] += other.cleanCounts[i]
+      self.trials += other.trials
+
+    def visitGrid(self):
+      """ Visits per trial as a list of rows, row y at index y. """
+      trials = float(max(self.trials, 1))
+      return [[self.visits[y * self.width + x] / trials for x in range(self.width)]
+              for y in range(self.height)]
+
+    def cleanTimeGrid(self):
+      """ Mean time step each tile was cleaned at as a list of rows, row y at
+      index y.  None for tiles that were never cleaned. """
+      grid = []
+      for y in range(self.height):
+        row = []
+        for x in range(self.width):
+          i = y * self.width + x
+          if self.cleanCounts[i]:
+            row.append(self.cleanTimes[i] / self.cleanCounts[i])
+          else:
+            row.append(None)
+        grid.append(row)
+      return grid
+
+    def hotspots(self, n = 10):
+      """ The N most visited tiles as ((x,y), visits per trial) pairs. """
+      trials = float(max(self.trials, 1))
+      top = sorted(range(len(self.visits)), key = lambda i: -self.visits[i])[:n]
+      return [((i % self.width, i // self.width), self.visits[i] / trials) for i in top]
+
+    def save(self, path):
+      """ Writes the raw counters to PATH as JSON. """
+      with open(path, 'w') as f:
+        json.dump({'width': self.width,
+                   'height': self.height,
+                   'trials': self.trials,
+                   'visits': list(self.visits),
+                   'cleanTimes': list(self.cleanTimes),
+                   'cleanCounts': list(self.cleanCounts)}, f)
+
+    @classmethod
+    def load(cls, path):
+      """ Reads a heatmap written by save(). """
+      with open(path) as f:
+        data = json.load(f)
+      heatmap = cls(data['width'], data['height'])
+      heatmap.trials = data['trials']
+      heatmap.visits = array('L', data['visits'])
+      heatmap.cleanTimes = array('d', data['cleanTimes'])
+      heatmap.cleanCounts = array('L', data['cleanCounts'])
+      return heatmap
+
+
+class PhaseProfiler(object):
+    """
+    Times the phases of runSimulation's time steps: the agent program
+    (runRobot), the rest of the robots' updatePositionAndClean (physics), the
+    termination check, the UI update and everything else (bookkeeping).
+    Only every EVERY-th step is timed, so the cost on the other steps is a
+    modulo and a check per robot.  Pass one to runSimulation(profiler = ...)
+    or testAllMaps, then print summary() or saveTrace() for chrome://tracing
+    or Perfetto.
+    At most MAX_EVENTS timed phases are kept for the trace; the summary
+    counts all of them.
+    """
+    clock = staticmethod(time.perf_counter)
+
+    def __init__(self, every = 100, max_events = 100000):
+      self.every = every
+      self.max_events = max_events
+      self.sampling = False
+      self.samples = 0
+      self.totals = {}    # phase -> seconds, not counting nested phases
+      self.calls = {}     # phase -> number of times timed
+      self.counters = {}  # counter -> value
+      self.events = []
+      self.childTime = 0.0
+      self.origin = self.clock()
+
+    def startStep(self, time):
+      """ Called at the start of time step TIME, returns True if it is timed. """
+      self.sampling = time % self.every == 0
+      if self.sampling:
+        self.samples += 1
+        self.childTime = 0.0
+      return self.sampling
+
+    def child(self, name, start, end):
+      """ Records a phase that runs inside the next phase passed to add(). """
+      self._record(name, start, end, end - start)
+      self.childTime += end - start
+
+    def add(self, name, start, end):
+      """ Records the phase NAME, from clock() START to END, less the time of
+      the child() phases recorded since the last add(). """
+      self._record(name, start, end, end - start - self.childTime)
+      self.childTime = 0.0
+
+    def _record(self, name, start, end, own):
+      self.totals[name] = self.totals.get(name, 0.0) + own
+      self.calls[name] = self.calls.get(name, 0) + 1
+      if len(self.events) < self.max_events:
+        self.events.append({'name': name, 'ph': 'X', 'pid': 0, 'tid': 0,
+                            'ts': (start - self.origin) * 1e6,
+                            'dur': (end - start) * 1e6})
+
+    def count(self, name, n = 1):
+      """ Adds N to the counter NAME, e.g. steps or trials. """
+      self.counters[name] = self.counters.get(name, 0) + n
+      if len(self.events) < self.max_events:
+        self.events.append({'name': name, 'ph': 'C', 'pid': 0, 'tid': 0,
+                            'ts': (self.clock() - self.origin) * 1e6,
+                            'args': {name: self.counters[name]}})
+
+    def merge(self, other):
+      """ Adds the timings and counters of another profiler, e.g. from
+      another process.  Its trace events are kept under their own pid. """
+      for name, t in other.totals.items():
+        self.totals[name] = self.totals.get(name, 0.0) + t
+        self.calls[name] = self.calls.get(name, 0) + other.calls[name]
+      for name, n in other.counters.items():
+        self.counters[name] = self.counters.get(name, 0) + n
+      self.samples += other.samples
+      pid = 1 + max([e['pid'] for e in self.events] or [0])
+      for event in other.events[:max(0, self.max_events - len(self.events))]:
+        event = dict(event)
+        event['pid'] = pid
+        self.events.append(event)
+
+    def summary(self):
+      """ Returns one line per phase with the mean time it took each time it
+      was timed and its share of the timed total, then the counters. """
+      total = sum(self.totals.values())
+      lines = ["  %-12s %8s %10s %7s" % ('phase', 'calls', 'us/call', 'share')]
+      for name in sorted(self.totals, key = lambda name: -self.totals[name]):
+        lines.append("  %-12s %8d %10.2f %6.1f%%" %
+                     (name, self.calls[name],
+                      self.totals[name] * 1e6 / self.calls[name],
+                      100.0 * self.totals[name] / total if total else 0.0))
+      for name in sorted(self.counters):
+        lines.append("  %-12s %8d" % (name, self.counters[name]))
+      return '\n'.join(lines)
+
+    def saveTrace(self, path):
+      """ Writes the timed phases to PATH in the Chrome trace event format. """
+      with open(path, 'w') as f:
+        json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ns'}, f)
@@ -0,0 +1,345 @@
+# roomba_service.py
+#
+# This file provides a job service, so that everyone running simulations on
+# a shared machine uses one SimulationPool instead of each starting a
+# process per CPU.  Start it once:
+#
+#     python3 roomba_service.py serve [PATH] [PROCESSES]
+#
+# then send it jobs from Python:
+#
+#     for event in submitJob('P1.aStarRobot', 'P1.allRooms', trials = 10):
+#         print(event)
+#
+# or from the command line:
+#
+#     python3 roomba_service.py submit P1.aStarRobot P1.allRooms 10 [PATH]
+#
+# Jobs are run one after another, each on every worker of the pool.  A job
+# sent while an identical one is queued or running is not run again: its
+# client is sent the events of the first one, from the start.
+#
+# The protocol is one line of JSON each way per message over a Unix socket
+# (SERVICE_PATH by default).  A job is a JSON object with
+#   'robot':       module.Class of the robot, e.g. 'P1.aStarRobot'
+#   'rooms':       module.name of a RoomCatalog or list of rooms
+#   'room_numbers': which of those rooms to run, default all
+#   'trials':      trials per room, default 10
+#   'chromosome', 'seed', 'min_clean', 'max_steps', 'trial_time': as for
+#                  concurrent_test; min_clean defaults to 0.95 like
+#                  testAllMaps, and a seed is drawn if none is given
+# and the service answers with events, objects whose 'event' is one of
+#   'queued':  {'job', 'seed', 'shared' (True if it joined an identical job)}
+#   'started': {'job'}
+#   'trial':   {'job', 'room', 'trial', 'steps' (the step budget if
+#               censored, None if it never ran), 'censored', 'finished',
+#               'total'} as each trial comes in
+#   'done':    {'job', 'score', 'rooms': [[score, std, finished, censored], ...]}
+# Censored trials are scored as their step budget, as in concurrent_test.
+#   'error':   {'job', 'message'}
+# The last event of a job is always 'done' or 'error'.
+# The service imports the modules jobs name and runs their robots, so
+# anyone who can connect to the socket can run code as the service's user.
+# The socket is made readable and writable by its owner and group only.
+
+from roomba_concurrent import *
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import importlib
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+
+SERVICE_PATH = os.path.join(tempfile.gettempdir(), 'roomba_service.sock')
+SOCKET_MODE = 0o660  # Owner and group may send jobs
+
+JOB_DEFAULTS = {'room_numbers': None,
+                'trials': 10,
+                'chromosome': None,
+                'seed': None,
+                'min_clean': 0.95,
+                'max_steps': None,
+                'trial_time': None}
+
+def findObject(path):
+    """ Imports the object called PATH, e.g. 'P1.aStarRobot'. """
+    module, dot, name = path.rpartition('.')
+    if not module:
+        raise ValueError("Expected module.name, got " + repr(path))
+    return getattr(importlib.import_module(module), name)
+
+def jobSpec(request):
+    """ The job asked for by REQUEST, a dict, with the defaults filled in.
+    Raises ValueError if it isn't a valid job. """
+    if not isinstance(request, dict):
+        raise ValueError("A job must be a JSON object")
+    for key in ('robot', 'rooms'):
+        if not isinstance(request.get(key), str):
+            raise ValueError("A job needs '%s' as module.name" % key)
+    unknown = set(request) - set(JOB_DEFAULTS) - set(['robot', 'rooms'])
+    if unknown:
+        raise ValueError("Unknown job fields: " + ', '.join(sorted(unknown)))
+    spec = dict(JOB_DEFAULTS)
+    spec.update(request)
+    if not isinstance(spec['trials'], int) or spec['trials'] < 1:
+        raise ValueError("'trials' must be a positive whole number")
+    return spec
+
+class Job(object):
+    """
+    A job of the service and the clients waiting on it.  Every event after
+    'queued' is kept, so a client that joins late is sent the ones it missed
+    first.
+    """
+
+    def __init__(self, number, spec):
+        self.number = number
+        self.spec = spec
+        self.key = json.dumps(spec, sort_keys = True)  # Same key, same job
+        self.seed = spec['seed']
+        if self.seed is None:
+            self.seed = random.getrandbits(32)
+        self.events = []
+        self.clients = set()    # asyncio.Queues of the clients' events
+        self.steps = None       # room -> {trial: RunningStats of its score}
+        self.censored = None    # room -> censored trials
+        self.finished = 0
+
+    def publish(self, event, **fields):
+        """ Sends the event EVENT, with FIELDS, to every client. """
+        message = dict(fields, event = event, job = self.number)
+        self.events.append(message)
+        for client in self.clients:
+            client.put_nowait(message)
+
+    def subscribe(self):
+        """ Returns a queue that gets every event of the job, from the first. """
+        client = asyncio.Queue()
+        for message in self.events:
+            client.put_nowait(message)
+        self.clients.add(client)
+        return client
+
+    def run(self, pool, loop):
+        """ Runs the job on POOL, from a thread other than LOOP's, sending
+        each trial's event through LOOP.  Returns the 'done' event's fields. """
+        spec = self.spec
+        robot = findObject(spec['robot'])
+        catalog = findObject(spec['rooms'])
+        if spec['room_numbers'] is not None:
+            # Only the rooms asked for, a RoomCatalog builds the others too
+            # if it is listed
+            rooms = [catalog[i] for i in spec['room_numbers']]
+        else:
+            rooms = list(catalog)
+        trials = spec['trials']
+        total = trials * len(rooms)
+        budget = stepBudget(spec['max_steps'])
+        self.steps = [{} for room in rooms]
+        self.censored = [0] * len(rooms)
+        def progress(num, first, stats, censored):
+            # One trial per unit, so its mean is the trial's score, unless
+            # it never ran
+            steps = stats.mean if stats.n else None
+            if steps is None:
+                stats = RunningStats([budget])
+            self.steps[num][first] = stats
+            self.censored[num] += censored
+            self.finished += 1
+            loop.call_soon_threadsafe(functools.partial(
+                self.publish, 'trial', room = num, trial = first,
+                steps = steps, censored = censored > 0,
+                finished = self.finished, total = total))
+        score = concurrent_test(robot, rooms, trials,
+                                min_clean = spec['min_clean'],
+                                chromosome = spec['chromosome'],
+                                seed = self.seed,
+                                max_steps = spec['max_steps'],
+                                trial_time = spec['trial_time'],
+                                timeout = None,
+                                chunk_trials = 1,
+                                pool = pool,
+                                progress = progress)
+        results = []
+        for (trialsteps, censored) in zip(self.steps, self.censored):
+            # Merge the trials in order, the same sums as concurrent_test
+            stats = RunningStats()
+            for trial in sorted(trialsteps):
+                stats.merge(trialsteps[trial])
+            (roomscore, std) = stats.meanstdv()
+            results.append([roomscore, std, trials - censored, censored])
+        return {'score': score, 'rooms': results}
+#end Job
+
+class JobService(object):
+    """
+    Takes jobs from clients on the Unix socket PATH and runs them one at a
+    time on a SimulationPool of PROCESSES workers (default one per CPU),
+    streaming their events back.  Call serve() to run it.
+    """
+
+    def __init__(self, path = SERVICE_PATH, processes = None, mode = SOCKET_MODE):
+        self.path = path
+        self.mode = mode
+        # Fork the workers now, before there are any threads
+        self.pool = SimulationPool(processes)
+        self.jobs = {}          # key -> Job queued or running
+        self.nextJob = 0
+        self.queue = None
+        self.loop = None
+        # Jobs run in this thread, so the event loop keeps serving clients
+        self.executor = ThreadPoolExecutor(1)
+
+    def serve(self):
+        """ Runs the service until interrupted. """
+        try:
+            asyncio.run(self.main())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        if os.path.exists(self.path):
+            # Left behind by a service that didn't stop cleanly?
+            probe = socket.socket(socket.AF_UNIX)
+            try:
+                probe.connect(self.path)
+                raise RuntimeError("A service is already listening on " + self.path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.remove(self.path)
+            finally:
+                probe.close()
+        server = await asyncio.start_unix_server(self.handleClient, self.path)
+        os.chmod(self.path, self.mode)
+        print("Serving jobs on %s with %d processes" % (self.path, len(self.pool)))
+        async with server:
+            await self.runJobs()
+
+    async def runJobs(self):
+        """ Runs the queued jobs one at a time. """
+        while True:
+            job = await self.queue.get()
+            if not job.clients:
+                del self.jobs[job.key]   # Everyone waiting for it has gone
+                continue
+            job.publish('started')
+            try:
+                done = await self.loop.run_in_executor(self.executor, job.run,
+                                                       self.pool, self.loop)
+            except Exception as e:
+                job.publish('error', message = '%s: %s' % (type(e).__name__, e))
+            else:
+                job.publish('done', **done)
+            finally:
+                del self.jobs[job.key]
+
+    async def handleClient(self, reader, writer):
+        """ Takes one job from a client and sends it the job's events. """
+        job = None
+        client = None
+        try:
+            line = await reader.readline()
+            try:
+                spec = jobSpec(json.loads(line))
+            except ValueError as e:
+                writer.write(self.encode({'event': 'error', 'job': None, 'message': str(e)}))
+                await writer.drain()
+                return
+            job = self.jobs.get(json.dumps(spec, sort_keys = True))
+            shared = job is not None
+            if job is None:
+                job = Job(self.nextJob, spec)
+                self.nextJob += 1
+                self.jobs[job.key] = job
+                self.queue.put_nowait(job)
+            client = job.subscribe()
+            writer.write(self.encode({'event': 'queued', 'job': job.number,
+                                      'seed': job.seed, 'shared': shared}))
+            await writer.drain()
+            # Clients send nothing more, so this finishes when one goes away
+            gone = asyncio.ensure_future(reader.read())
+            try:
+                while True:
+                    message = asyncio.ensure_future(client.get())
+                    await asyncio.wait([message, gone],
+                                       return_when = asyncio.FIRST_COMPLETED)
+                    if not message.done():
+                        message.cancel()
+                        break   # The client has gone, stop waiting for its job
+                    message = message.result()
+                    writer.write(self.encode(message))
+                    await writer.drain()
+                    if message['event'] in ('done', 'error'):
+                        break
+            finally:
+                gone.cancel()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass    # The client has gone
+        finally:
+            if client is not None:
+                job.clients.discard(client)
+            writer.close()
+
+    @staticmethod
+    def encode(message):
+        return (json.dumps(message) + '\n').encode('utf-8')
+
+    def close(self):
+        """ Stops the workers and removes the socket. """
+        self.executor.shutdown(wait = False)
+        self.pool.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+#end JobService
+
+def submitJob(robot, rooms, trials = 10, path = SERVICE_PATH, **options):
+    """ Sends the job of running ROBOT (module.Class) TRIALS times on each of
+    the ROOMS (module.name of a RoomCatalog or list) with the other job
+    fields in OPTIONS to the service at PATH, and yields its events, as
+    dicts, as they arrive. """
+    request = dict(options, robot = robot, rooms = rooms, trials = trials)
+    sock = socket.socket(socket.AF_UNIX)
+    sock.connect(path)
+    try:
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        for line in sock.makefile('r', encoding = 'utf-8'):
+            event = json.loads(line)
+            yield event
+            if event['event'] in ('done', 'error'):
+                break
+    finally:
+        sock.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2 and sys.argv[1] == 'serve' and len(sys.argv) <= 4:
+        JobService(sys.argv[2] if len(sys.argv) > 2 else SERVICE_PATH,
+                   int(sys.argv[3]) if len(sys.argv) > 3 else None).serve()
+    elif len(sys.argv) in (5, 6) and sys.argv[1] == 'submit':
+        path = sys.argv[5] if len(sys.argv) > 5 else SERVICE_PATH
+        for event in submitJob(sys.argv[2], sys.argv[3], int(sys.argv[4]), path):
+            if event['event'] == 'trial':
+                print("Room %d trial %d: %s (%d of %d)" %
+                      (event['room'], event['trial'],
+                       'censored' if event['censored'] else event['steps'],
+                       event['finished'], event['total']))
+            elif event['event'] == 'done':
+                for i, (score, std, finished, censored) in enumerate(event['rooms']):
+                    print("Room %d of %d done (score: %d std: %d) with %d finished and %d censored" %
+                          (i + 1, len(event['rooms']), score, std, finished, censored))
+                print("Average score: %d" % event['score'])
+            elif event['event'] == 'error':
+                print("Error: " + event['message'])
+                sys.exit(1)
+            else:
+                print("Job %d %s" % (event['job'], event['event']))
+    else:
+        print("Usage: %s serve [PATH] [PROCESSES]" % sys.argv[0])
+        print("       %s submit ROBOT ROOMS TRIALS [PATH]" % sys.argv[0])
+        sys.exit(1)
@@ -4,17 +4,45 @@
 # This file provides classes and functions to simulate a Roomba-style robot in GUI and
 # batch modes.  
 
+import hashlib
 import math
+import os
+import pickle
 import random
-import copy
+import time
 
-import roomba_visualize
+# roomba_visualize (and with it tkinter) is only imported by runSimulation
+# when ui_enable is set, so batch runs and worker processes start faster and
+# work on machines without tkinter.
 
 REALISTIC_LEAN_MAX = 0.1  # Max degrees per timestep for lean
 REALISTIC_MARBLE_PROBABILITY = 0.01  # Prob of a marble being hit in a timestep
 REALISTIC_MARBLE_MAX = 10  # How much the marble rotates the robot
 EDGE_REFINEMENT_STEPS = 4
 
+TILE_CLEAN = 0  # Tile states used by GridRoom
+TILE_DIRTY = 1
+TILE_WALL = 2
+CHUNK_SIZE = 64  # Tiles per side of a TiledRoom chunk
+RAY_EPSILON = 1e-9  # How far short of a wall castRay stops
+
+# sin and cos of every whole degree, since headings are usually whole degrees
+SIN_TABLE = [math.sin(math.radians(d)) for d in range(360)]
+COS_TABLE = [math.cos(math.radians(d)) for d in range(360)]
+
+# Percept tuples are shared rather than built on every step.  Index by the
+# result of isTileDirty.
+PERCEPTS = {None: (None, None), 'Dirty': (None, 'Dirty')}
+BUMP_PERCEPTS = {None: ('Bump', None), 'Dirty': ('Bump', 'Dirty')}
+
+ROBOT_SIZE = 0.5  # Diameter of a robot in tiles, when robots bump into each other
+CYCLE_PRECISION = 9  # Decimal places of robot poses compared by cycle detection
+
+CHECKPOINT_STEPS = 10000  # Time steps between checkpoints within a trial
+CURVE_STEPS = 100  # Time steps between samples of the clean fraction
+CLOCK_STEPS = 256  # Time steps between looks at the clock, with a time budget
+SKETCH_ACCURACY = 0.01  # Relative error of QuantileSketch quantiles
+
 MAX_STEPS_IN_SIMULATION = 99999  # Number of time steps to allow a robot to clean a room
                                 # before we give up.  Prevents runaway robots who can't
                                 # clean.
@@ -55,7 +83,10 @@ class RectangularRoom(object):
         for i in range(int(dirt_coverage * width * height)):
           d = alldirt.pop()
           self.dirt.add(d)
-        self.dirtStarting = copy.deepcopy(self.dirt)
+        self.dirtStarting = set(self.dirt)
+        self.undoLog = None  # Tiles cleaned since beginUndo(), if recording
+        self._wallView = None  # Cached read-only copies for getWalls/getDirt
+        self._dirtView = None
 
     def cleanTileAtPosition(self, pos):
         """
@@ -69,6 +100,9 @@ class RectangularRoom(object):
         y = math.floor(y)
         if (x,y)  in self.dirt:
             self.dirt.remove((x,y))
+            self._dirtView = None
+            if self.undoLog is not None:
+              self.undoLog.append((x,y))
             
     def isTileDirty(self, pos ):
         """
@@ -98,6 +132,17 @@ class RectangularRoom(object):
     def setWall(self, x1_y1, x2_y2):
       """ Draws a wall from (x1,y1) to (x2,y2) 
         Will widen wall so robot can't jump over."""
+      self.occupied.update(self._wallTiles(x1_y1, x2_y2))
+      # Remove these walls from dirt
+      self.dirt = self.dirt - self.occupied
+      self.dirtStarting = self.dirtStarting - self.occupied
+      self._wallView = None
+      self._dirtView = None
+
+    def _wallTiles(self, x1_y1, x2_y2):
+      """ Returns the list of tiles (x,y) covered by a wall from (x1,y1) to
+        (x2,y2), widened so a robot can't jump over it."""
+      tiles = []
       x1, y1 = x1_y1
       x2, y2 = x2_y2
       if x1 > x2: # make sure x1 < x2
@@ -115,14 +160,61 @@ class RectangularRoom(object):
         y = x * m + b
         blockx = math.floor(x + 0.5)
         blocky = math.floor(y + 0.5)
-        self.occupied.add( (blockx, blocky) )
+        tiles.append( (blockx, blocky) )
         if x != x1 and lx != blockx and ly != blocky:
-          self.occupied.add( (blockx-1, blocky) )
+          tiles.append( (blockx-1, blocky) )
         (lx, ly) = (blockx, blocky)
         x +=step
-      # Remove these walls from dirt
-      self.dirt = self.dirt - self.occupied
-      self.dirtStarting = self.dirtStarting - self.occupied
+      return tiles
+
+    def castRay(self, pos, angle, dist):
+        """
+        Follows a straight line from POS heading ANGLE (degrees, 0 is North,
+        90 East) for DIST, one tile boundary at a time, and stops at the first
+        occupied tile.  Nothing is skipped however long DIST is.
+
+        Returns (end, cells, hit): end is the (x,y) where the line stops, just
+        short of the occupied tile if one was hit; cells is the list of tiles
+        (x,y) visited, starting with the one under POS; hit is True if an
+        occupied tile stopped the line.
+        """
+        x, y = pos
+        if dist < 0:  # going backwards
+          angle += 180
+          dist = -dist
+        dx = math.sin(math.radians(angle))
+        dy = math.cos(math.radians(angle))
+        cx = math.floor(x)
+        cy = math.floor(y)
+        cells = [(cx, cy)]
+        # Distance along the line to the next vertical / horizontal tile edge,
+        # and between two of them
+        if dx > 0:
+          stepx, tx, deltax = 1, (cx + 1 - x) / dx, 1 / dx
+        elif dx < 0:
+          stepx, tx, deltax = -1, (x - cx) / -dx, -1 / dx
+        else:
+          stepx, tx, deltax = 0, float('inf'), float('inf')
+        if dy > 0:
+          stepy, ty, deltay = 1, (cy + 1 - y) / dy, 1 / dy
+        elif dy < 0:
+          stepy, ty, deltay = -1, (y - cy) / -dy, -1 / dy
+        else:
+          stepy, ty, deltay = 0, float('inf'), float('inf')
+        while True:
+          t = min(tx, ty)
+          if t > dist:
+            return (x + dist * dx, y + dist * dy), cells, False
+          if tx < ty:
+            cx += stepx
+            tx += deltax
+          else:
+            cy += stepy
+            ty += deltay
+          if self.isTileOccupied((cx, cy)):
+            t = max(0.0, t - RAY_EPSILON)
+            return (x + t * dx, y + t * dy), cells, True
+          cells.append((cx, cy))
 
     def getNumTiles(self):
         """ Return the total number of tiles in the room.
@@ -135,7 +227,7 @@ class RectangularRoom(object):
         """   Return the total number of clean tiles in the room.
         returns: an integer
         """
-        return self.getNumTiles() - len(set(self.dirt))
+        return self.getNumTiles() - len(self.dirt)
 
     def getRandomPosition(self):
         """ Return a random unoccupied position inside the room.
@@ -158,14 +250,396 @@ class RectangularRoom(object):
       return self.height
       
     def getWalls(self):
-      """ Returns a list of all immovible cells in the room.  
+      """ Returns a frozenset of all immovible cells in the room.  
       Each location is a tuple (x,y)"""
-      return copy.deepcopy(self.occupied) # return a copy so you can't change it!
+      # frozen so you can't change it, and cached since walls rarely change
+      if self._wallView is None:
+        self._wallView = frozenset(self.occupied)
+      return self._wallView
       
     def getDirt(self):
-      """ Returns a list of all cleaned cells in the room.
+      """ Returns a frozenset of all dirty cells in the room.
       Each location is a tuple (x,y)"""
-      return copy.deepcopy(self.dirt) # return a copy so you can't change it!
+      # Only rebuilt after dirt has been cleaned
+      if self._dirtView is None:
+        self._dirtView = frozenset(self.dirt)
+      return self._dirtView
+
+    def beginUndo(self):
+      """ Start recording cleaned tiles so restoreDirt() can put them back.
+      Much cheaper than copying the whole room for every trial."""
+      self.undoLog = []
+
+    def restoreDirt(self):
+      """ Put back all dirt cleaned since beginUndo() and stop recording."""
+      if self.undoLog:
+        self.dirt.update(self.undoLog)
+        self._dirtView = None
+      self.undoLog = None
+
+    def getCleaned(self, start = 0):
+      """ Returns the list of tiles (x,y) cleaned since beginUndo(), in order,
+      skipping the first START of them."""
+      return list(self.undoLog[start:]) if self.undoLog else []
+
+    def layoutDigest(self):
+      """ Returns a hash of where the walls and dirt are, so rooms of the
+      same size with different layouts can be told apart. """
+      digest = hashlib.sha1()
+      digest.update(repr(sorted(self.occupied)).encode('ascii'))
+      digest.update(repr(sorted(self.dirt)).encode('ascii'))
+      return digest.hexdigest()
+
+
+class GridRoom(RectangularRoom):
+    """
+    A RectangularRoom that keeps its tiles in a flat bytearray rather than sets
+    of (x,y) tuples.  The number of navigable and dirty tiles are kept as
+    running counters, so getNumTiles() and getNumCleanTiles() are O(1).
+
+    The border walls are stored as a one tile frame around the room, so tile
+    (x,y) lives at index (y + 1) * (width + 2) + (x + 1).  Each tile is one of
+    TILE_CLEAN, TILE_DIRTY or TILE_WALL.
+    """
+    def __init__(self, width, height, dirt_coverage = 1.0):
+        """
+        Same arguments as RectangularRoom.
+        """
+        stride = width + 2
+        tiles = bytearray(stride * (height + 2))
+        # Fill room edges with walls
+        for x in range(stride):
+          tiles[x] = TILE_WALL
+          tiles[(height + 1) * stride + x] = TILE_WALL
+        for y in range(height + 2):
+          tiles[y * stride] = TILE_WALL
+          tiles[y * stride + width + 1] = TILE_WALL
+        # Place dirt randomly in the environment without building a list of
+        # every tile
+        num_dirt = int(dirt_coverage * width * height)
+        for i in random.sample(range(width * height), num_dirt):
+          tiles[(i % height + 1) * stride + i // height + 1] = TILE_DIRTY
+        self._setTiles(width, height, tiles)
+
+    def _setTiles(self, width, height, tiles):
+        """ Makes TILES, a bytearray laid out as described above, the state
+        of this WIDTH x HEIGHT room and its starting state. """
+        self.width = width
+        self.height = height
+        self.stride = width + 2
+        if len(tiles) != self.stride * (height + 2):
+          raise ValueError("Tile array does not match a %dx%d room" % (width, height))
+        self.tiles = tiles
+        self.numTiles = len(tiles) - tiles.count(TILE_WALL)
+        self.numDirty = tiles.count(TILE_DIRTY)
+        self.tilesStarting = bytearray(tiles)  # Copy of tiles at beginning
+        self.undoLog = None
+        self._wallView = None
+        self._dirtView = None
+
+    @classmethod
+    def fromRoom(cls, room):
+        """ Returns a GridRoom with the same size, walls and dirt as ROOM. """
+        grid = cls(room.getWidth(), room.getHeight(), 0.0)
+        for (x, y) in room.getWalls():
+          grid._setTile(x, y, TILE_WALL)
+        for (x, y) in room.getDirt():
+          grid._setTile(x, y, TILE_DIRTY)
+        grid.tilesStarting = bytearray(grid.tiles)
+        return grid
+
+    @classmethod
+    def fromTiles(cls, width, height, tiles):
+        """ Returns a GridRoom using TILES, a bytes-like tile array laid out as
+        described above, as its state.  The one tile border must already be
+        TILE_WALL.  No dirt is placed or walls drawn. """
+        grid = cls.__new__(cls)
+        grid._setTiles(width, height, bytearray(tiles))
+        return grid
+
+    def _index(self, x, y):
+        """ Index of tile (x,y) in self.tiles, or -1 if outside the frame. """
+        if x < -1 or x > self.width or y < -1 or y > self.height:
+          return -1
+        return (y + 1) * self.stride + x + 1
+
+    def _setTile(self, x, y, state):
+        """ Sets tile (x,y) to STATE, keeping the counters up to date. """
+        i = self._index(x, y)
+        if i < 0:
+          return
+        old = self.tiles[i]
+        if old == state:
+          return
+        self._dirtView = None
+        if TILE_WALL in (old, state):
+          self._wallView = None
+        if old == TILE_DIRTY:
+          self.numDirty -= 1
+        elif old == TILE_WALL:
+          self.numTiles += 1
+        if state == TILE_DIRTY:
+          self.numDirty += 1
+        elif state == TILE_WALL:
+          self.numTiles -= 1
+        self.tiles[i] = state
+
+    def cleanTileAtPosition(self, pos):
+        x,y = pos
+        i = self._index(math.floor(x), math.floor(y))
+        if i >= 0 and self.tiles[i] == TILE_DIRTY:
+          self.tiles[i] = TILE_CLEAN
+          self.numDirty -= 1
+          self._dirtView = None
+          if self.undoLog is not None:
+            self.undoLog.append(i)
+
+    def isTileDirty(self, pos):
+        x,y = pos
+        i = self._index(math.floor(x), math.floor(y))
+        if i >= 0 and self.tiles[i] == TILE_DIRTY:
+          return 'Dirty'
+        return None
+
+    def isTileOccupied(self, pos):
+        x,y = pos
+        i = self._index(math.floor(x), math.floor(y))
+        return i < 0 or self.tiles[i] == TILE_WALL
+
+    def setWall(self, x1_y1, x2_y2):
+        for (x, y) in self._wallTiles(x1_y1, x2_y2):
+          self._setTile(x, y, TILE_WALL)
+          i = self._index(x, y)
+          if i >= 0:
+            self.tilesStarting[i] = TILE_WALL
+
+    def getNumTiles(self):
+        return self.numTiles
+
+    def getNumCleanTiles(self):
+        return self.numTiles - self.numDirty
+
+    def _tilesOfState(self, state):
+        """ Returns a set of (x,y) for every tile in STATE. """
+        found = set()
+        stride = self.stride
+        i = self.tiles.find(state)
+        while i >= 0:
+          found.add((i % stride - 1, i // stride - 1))
+          i = self.tiles.find(state, i + 1)
+        return found
+
+    def getWalls(self):
+        if self._wallView is None:
+          self._wallView = frozenset(self._tilesOfState(TILE_WALL))
+        return self._wallView
+
+    def getDirt(self):
+        if self._dirtView is None:
+          self._dirtView = frozenset(self._tilesOfState(TILE_DIRTY))
+        return self._dirtView
+
+    def getTiles(self):
+        """ Returns a read-only memoryview of the tile array, see _index(). """
+        return memoryview(self.tiles).toreadonly()
+
+    def restoreDirt(self):
+        if self.undoLog:
+          for i in self.undoLog:
+            self.tiles[i] = TILE_DIRTY
+          self.numDirty += len(self.undoLog)
+          self._dirtView = None
+        self.undoLog = None
+
+    def getCleaned(self, start = 0):
+        stride = self.stride
+        return [(i % stride - 1, i // stride - 1) for i in (self.undoLog or ())[start:]]
+
+    def layoutDigest(self):
+        return hashlib.sha1(bytes(self.tiles)).hexdigest()
+
+
+class TiledRoom(RectangularRoom):
+    """
+    A RectangularRoom for very large floors.  The room is split into square
+    chunks of CHUNK_SIZE x CHUNK_SIZE tiles, and a chunk is only stored once a
+    robot looks at or cleans a tile in it (or a wall is drawn through it), so
+    memory grows with the area visited rather than the floor area.
+
+    The dirt of each chunk comes from its own random generator seeded with
+    SEED and the chunk coordinates, so a chunk has the same dirt whenever it
+    is made.  The border walls are not stored at all.
+    """
+    def __init__(self, width, height, dirt_coverage = 1.0, seed = None):
+        """
+        Same arguments as RectangularRoom, plus
+        seed: an integer the dirt is generated from.  Default is random.
+        """
+        self.width = width
+        self.height = height
+        self.dirt_coverage = dirt_coverage
+        if seed is None:
+          seed = random.getrandbits(64)
+        self.seed = seed
+        self.chunks = {}  # (cx, cy) -> bytearray of tile states
+        self.occupied = set()  # Walls inside the room (x,y)
+        self.wallChunks = set()  # Chunks that hold a wall
+        self.newChunks = None  # Chunks made since beginUndo()
+        self.undoLog = None
+        self._wallView = None
+        self._dirtView = None
+        self.numTiles = width * height
+        self.numDirty = 0
+        for cx in range((width + CHUNK_SIZE - 1) // CHUNK_SIZE):
+          for cy in range((height + CHUNK_SIZE - 1) // CHUNK_SIZE):
+            cw, ch = self._chunkSize(cx, cy)
+            self.numDirty += int(dirt_coverage * cw * ch)
+
+    def _chunkSize(self, cx, cy):
+        """ Width and height in tiles of chunk (cx, cy). """
+        return (min(CHUNK_SIZE, self.width - cx * CHUNK_SIZE),
+                min(CHUNK_SIZE, self.height - cy * CHUNK_SIZE))
+
+    def _makeChunk(self, key):
+        """ Returns the starting tiles of chunk KEY, without storing them. """
+        cx, cy = key
+        cw, ch = self._chunkSize(cx, cy)
+        chunk = bytearray(CHUNK_SIZE * CHUNK_SIZE)
+        rng = random.Random('%d:%d:%d' % (self.seed, cx, cy))
+        for i in rng.sample(range(cw * ch), int(self.dirt_coverage * cw * ch)):
+          chunk[(i // cw) * CHUNK_SIZE + i % cw] = TILE_DIRTY
+        return chunk
+
+    def _chunk(self, key):
+        """ Returns the tiles of chunk KEY, making and storing them if needed. """
+        chunk = self.chunks.get(key)
+        if chunk is None:
+          chunk = self.chunks[key] = self._makeChunk(key)
+          if self.newChunks is not None:
+            self.newChunks.append(key)
+        return chunk
+
+    def _locate(self, x, y):
+        """ Returns the chunk and index of tile (x,y), or (None, -1) if it is
+        outside the room. """
+        if x < 0 or x >= self.width or y < 0 or y >= self.height:
+          return None, -1
+        return ((x // CHUNK_SIZE, y // CHUNK_SIZE),
+                (y % CHUNK_SIZE) * CHUNK_SIZE + x % CHUNK_SIZE)
+
+    def cleanTileAtPosition(self, pos):
+        x,y = pos
+        key, i = self._locate(math.floor(x), math.floor(y))
+        if key is None:
+          return
+        chunk = self._chunk(key)
+        if chunk[i] == TILE_DIRTY:
+          chunk[i] = TILE_CLEAN
+          self.numDirty -= 1
+          self._dirtView = None
+          if self.undoLog is not None:
+            self.undoLog.append((key, i))
+
+    def isTileDirty(self, pos):
+        x,y = pos
+        key, i = self._locate(math.floor(x), math.floor(y))
+        if key is not None and self._chunk(key)[i] == TILE_DIRTY:
+          return 'Dirty'
+        return None
+
+    def isTileOccupied(self, pos):
+        x,y = pos
+        key, i = self._locate(math.floor(x), math.floor(y))
+        if key is None:
+          return True
+        # Walls only exist in stored chunks
+        chunk = self.chunks.get(key)
+        return chunk is not None and chunk[i] == TILE_WALL
+
+    def setWall(self, x1_y1, x2_y2):
+        for (x, y) in self._wallTiles(x1_y1, x2_y2):
+          key, i = self._locate(x, y)
+          if key is None:
+            continue  # Border walls are implied
+          chunk = self._chunk(key)
+          if chunk[i] == TILE_WALL:
+            continue
+          if chunk[i] == TILE_DIRTY:
+            self.numDirty -= 1
+          self.numTiles -= 1
+          chunk[i] = TILE_WALL
+          self.occupied.add((x, y))
+          self.wallChunks.add(key)
+        self._wallView = None
+        self._dirtView = None
+
+    def getNumTiles(self):
+        return self.numTiles
+
+    def getNumCleanTiles(self):
+        return self.numTiles - self.numDirty
+
+    def getWalls(self):
+        if self._wallView is None:
+          border = set()
+          for x in range(-1, self.width + 1):
+            border.add((x, -1))
+            border.add((x, self.height))
+          for y in range(-1, self.height + 1):
+            border.add((-1, y))
+            border.add((self.width, y))
+          self._wallView = frozenset(border | self.occupied)
+        return self._wallView
+
+    def getDirt(self):
+        """ Looks at every chunk, so this costs time in proportion to the floor
+        area, but chunks that weren't stored yet still aren't. """
+        if self._dirtView is None:
+          dirt = set()
+          for cx in range((self.width + CHUNK_SIZE - 1) // CHUNK_SIZE):
+            for cy in range((self.height + CHUNK_SIZE - 1) // CHUNK_SIZE):
+              chunk = self.chunks.get((cx, cy))
+              if chunk is None:
+                chunk = self._makeChunk((cx, cy))
+              i = chunk.find(TILE_DIRTY)
+              while i >= 0:
+                dirt.add((cx * CHUNK_SIZE + i % CHUNK_SIZE,
+                          cy * CHUNK_SIZE + i // CHUNK_SIZE))
+                i = chunk.find(TILE_DIRTY, i + 1)
+          self._dirtView = frozenset(dirt)
+        return self._dirtView
+
+    def beginUndo(self):
+        self.undoLog = []
+        self.newChunks = []
+
+    def restoreDirt(self):
+        if self.undoLog:
+          for (key, i) in self.undoLog:
+            self.chunks[key][i] = TILE_DIRTY
+          self.numDirty += len(self.undoLog)
+          self._dirtView = None
+        # Chunks first made during the trial are back to how they started, so
+        # drop them unless a wall was drawn in them
+        for key in self.newChunks or ():
+          if key not in self.wallChunks:
+            del self.chunks[key]
+        self.undoLog = None
+        self.newChunks = None
+
+    def getCleaned(self, start = 0):
+        return [(cx * CHUNK_SIZE + i % CHUNK_SIZE, cy * CHUNK_SIZE + i // CHUNK_SIZE)
+                for ((cx, cy), i) in (self.undoLog or ())[start:]]
+
+    def layoutDigest(self):
+        """ Chunks not stored yet are made from the seed, so the seed, the
+        walls and the dirt of the stored chunks are enough. """
+        digest = hashlib.sha1()
+        digest.update(repr((self.seed, self.dirt_coverage, sorted(self.occupied))).encode('ascii'))
+        for key in sorted(self.chunks):
+          digest.update(repr(key).encode('ascii'))
+          digest.update(bytes(self.chunks[key]))
+        return digest.hexdigest()
 
 
 class RobotBase(object):
@@ -179,6 +653,9 @@ class RobotBase(object):
     Subclasses of Robot should provide movement strategies by implementing
     updatePositionAndClean(), which simulates a single time-step.
     """
+    __slots__ = ('pos', 'dir', 'room', 'last', 'speed', 'blocked', 'fleet', 'rng',
+                 'profiler')
+
     def __init__(self, room, speed, start_location = -1):
         """
         Initializes a Robot with the given speed in the specified room. The
@@ -199,6 +676,16 @@ class RobotBase(object):
           self.dir = 90.0
         self.room = room
         self.last = None
+        # Whether the robot can't be at a position.  Just walls, unless the
+        # robot joins a fleet.
+        self.blocked = room.isTileOccupied
+        self.fleet = None
+        # The random.Random the simulator draws this robot's noise from, or
+        # None for the random module.  Set by runSimulation when seeded.
+        self.rng = None
+        # The roomba_metrics.PhaseProfiler timing the robot's runRobot calls,
+        # if any.  Set by runSimulation when profiling.
+        self.profiler = None
         if speed > 0:
             self.speed = speed
         else:
@@ -258,13 +745,34 @@ class RobotBase(object):
         """
         old_x, old_y = self.pos
         # Compute the change in position
-        delta_y = speed * math.cos(math.radians(angle))
-        delta_x = speed * math.sin(math.radians(angle))
+        sin_a, cos_a = self.headingVector(angle)
+        delta_y = speed * cos_a
+        delta_x = speed * sin_a
         # Add that to the existing position
         new_x = old_x + delta_x
         new_y = old_y + delta_y
         return (new_x, new_y)   
+
+    def headingVector(self, angle):
+        """ Returns (sin, cos) of ANGLE in degrees, from a table when ANGLE is a
+        whole number of degrees.  Headings aren't kept within 0..360, so it
+        is wrapped first. """
+        if angle % 1 == 0:  # False for inf and nan as well
+          i = int(angle) % 360
+          return SIN_TABLE[i], COS_TABLE[i]
+        return math.sin(math.radians(angle)), math.cos(math.radians(angle))
         
+    def joinFleet(self, fleet):
+        """ Adds the robot to FLEET, a RobotIndex, so it bumps into the other
+        robots in it as well as into walls. """
+        self.fleet = fleet
+        fleet.add(self)
+        self.blocked = self.blockedInFleet
+
+    def blockedInFleet(self, pos):
+        """ True if POS is a wall or too close to another robot in the fleet. """
+        return self.room.isTileOccupied(pos) or self.fleet.collides(self, pos)
+
     def centerInCell(self):
       """ Moves the position to the middle of a cell (x.5, y.5)"""
       x, y = self.pos
@@ -272,55 +780,148 @@ class RobotBase(object):
       y = int(y) + 0.5
       self.pos = (x,y)
           
+class RobotIndex(object):
+    """
+    A spatial hash of robot positions, so a robot can find the robots near it
+    without looking at all of them.  Robots are RobotBase objects of diameter
+    SIZE, hashed into square cells SIZE wide, so any robot it could touch is
+    in its own cell or one of the 8 around it.  runSimulation moves robots in
+    the index after each one has taken its time step.
+    """
+    def __init__(self, size = ROBOT_SIZE):
+      self.size = size
+      self.cells = {}  # (cx, cy) -> list of the robots in that cell
+
+    def _cell(self, pos):
+      return (int(math.floor(pos[0] / self.size)), int(math.floor(pos[1] / self.size)))
+
+    def add(self, robot):
+      """ Adds ROBOT at its current position. """
+      self.cells.setdefault(self._cell(robot.pos), []).append(robot)
+
+    def remove(self, robot, pos = None):
+      """ Removes ROBOT, which was added at POS (default its position). """
+      key = self._cell(robot.pos if pos is None else pos)
+      cell = self.cells[key]
+      cell.remove(robot)
+      if not cell:
+        del self.cells[key]
+
+    def move(self, robot, oldpos):
+      """ Updates the index after ROBOT moved from OLDPOS to its position. """
+      key = self._cell(robot.pos)
+      if key != self._cell(oldpos):
+        self.remove(robot, oldpos)
+        self.cells.setdefault(key, []).append(robot)
+
+    def near(self, pos):
+      """ Yields the robots in the cells around POS. """
+      cx, cy = self._cell(pos)
+      cells = self.cells
+      for x in (cx - 1, cx, cx + 1):
+        for y in (cy - 1, cy, cy + 1):
+          cell = cells.get((x, y))
+          if cell:
+            for robot in cell:
+              yield robot
+
+    def collides(self, robot, pos):
+      """ True if ROBOT at POS would overlap another robot. """
+      x, y = pos
+      limit = self.size * self.size
+      for other in self.near(pos):
+        if other is not robot:
+          dx = other.pos[0] - x
+          dy = other.pos[1] - y
+          if dx * dx + dy * dy < limit:
+            return True
+      return False
+
+    def __len__(self):
+      return sum(len(cell) for cell in self.cells.values())
+
 class ContinuousRobot(object):
     """ This class of robot lives in a continuous world where the robot can turn in any
     direction ('TurnLeft' or 'TurnRight') any number of degrees, go 'Forward' at some 
     speed (100 is full step distance), or 'Suck' dirt.  
     Deterministic environment.
+
+    Set reflex = True in a subclass whose runRobot only looks at self.percepts
+    and always picks the same action for the same percept.  The batch
+    simulator (roomba_batch.py) can then run it once per percept, not per trial.
+
+    Set exactCollision = True to move with RectangularRoom.castRay instead of
+    checking a few points along the step, so the robot stops right at walls
+    and can't jump through them at any speed.  With vacuumWhileMoving = True
+    as well, every tile passed over is cleaned.
     """
+    reflex = False
+    exactCollision = False
+    vacuumWhileMoving = False
+
+    __slots__ = ('robot', 'percepts', 'actions', 'action')
+
+    # Valid actions (['TurnLeft', 'TurnRight', 'Forward', 'Suck'],
+    #    <turn amount in degrees, speed forward/back [0..100]>)
+    #    None is default (90 degrees or 100 percent)
+    # mapped to the name of the method performing them
+    ACTION_METHODS = (('TurnLeft', 'turnLeft'), ('TurnRight', 'turnRight'),
+                      ('Suck', 'suck'), ('Forward', 'forward'))
+
     def __init__(self,room, speed, start_location = -1, chromosome = None):
+        # actions dictionary of bound methods, which subclasses may change
+        self.actions = dict((act, getattr(self, name)) for (act, name) in self.ACTION_METHODS)
         self.initialize(chromosome)
         self.robot = RobotBase(room, speed, start_location)
         # Valid percepts (['Bump',None],['Dirty',None])
-        self.percepts = (None,self.robot.room.isTileDirty(self.robot.pos) )
-        #self.actions = (None,None) 
-          # Valid actions (['TurnLeft', 'TurnRight', 'Forward', 'Suck'],
-                    #    <turn amount in degrees, speed forward/back [0..100]>)
-                    #    None is default (90 degrees or 100 percent)
-
-        # actions dictionary
-        self.actions = {}
-        self.actions['TurnLeft'] = self.turnLeft
-        self.actions['TurnRight'] = self.turnRight
-        self.actions['Suck'] = self.suck
-        self.actions['Forward'] = self.forward
+        self.percepts = PERCEPTS[self.robot.room.isTileDirty(self.robot.pos)]
 
     def initialize(self, chromosome):
       """ A hook called during __init__ """
 
     def turnLeft(self, amt):
         # Will reset bump
-        self.percepts = (None,self.robot.room.isTileDirty(self.robot.pos))
+        self.percepts = PERCEPTS[self.robot.room.isTileDirty(self.robot.pos)]
         self.robot.dir = int(self.robot.dir - amt % 360)
 
     def turnRight(self, amt):
         # Will reset bump
-        self.percepts = (None,self.robot.room.isTileDirty(self.robot.pos))
+        self.percepts = PERCEPTS[self.robot.room.isTileDirty(self.robot.pos)]
         self.robot.dir = int(self.robot.dir + amt % 360)
 
     def suck(self, amt):
         self.robot.room.cleanTileAtPosition(self.robot.pos)
-        self.percepts = (None,self.robot.room.isTileDirty(self.robot.pos))
+        self.percepts = PERCEPTS[self.robot.room.isTileDirty(self.robot.pos)]
 
     def forward(self, amt):
+        if self.exactCollision:
+          room = self.robot.room
+          end, cells, hit = room.castRay(self.robot.pos, self.robot.dir,
+                                         self.robot.speed * amt / 100.0)
+          if self.robot.fleet is not None and self.robot.fleet.collides(self.robot, end):
+            # Another robot is in the way, so don't move at all
+            self.percepts = BUMP_PERCEPTS[room.isTileDirty(self.robot.pos)]
+            return
+          self.robot.pos = end
+          if self.vacuumWhileMoving:
+            for cell in cells:
+              room.cleanTileAtPosition(cell)
+          percepts = BUMP_PERCEPTS if hit else PERCEPTS
+          self.percepts = percepts[room.isTileDirty(end)]
+          return
         # Robot observed jumping through walls, so let's check half step
-        halfpos = self.robot.getNewPosition(self.robot.dir, self.robot.speed * amt / 50.0)
-        newpos = self.robot.getNewPosition(self.robot.dir, self.robot.speed * amt / 100.0)
-        if not (self.robot.room.isTileOccupied(newpos) 
-              or self.robot.room.isTileOccupied(halfpos)):
+        robot = self.robot
+        x, y = robot.pos
+        sin_a, cos_a = robot.headingVector(robot.dir)
+        halfdist = robot.speed * amt / 50.0
+        dist = robot.speed * amt / 100.0
+        halfpos = (x + halfdist * sin_a, y + halfdist * cos_a)
+        newpos = (x + dist * sin_a, y + dist * cos_a)
+        if not (robot.blocked(newpos) 
+              or robot.blocked(halfpos)):
             # Assume the floor is clear between here and there
-            self.robot.pos = newpos
-            self.percepts = (None,self.robot.room.isTileDirty(self.robot.pos))
+            robot.pos = newpos
+            self.percepts = PERCEPTS[robot.room.isTileDirty(newpos)]
         else:
             # Can't take a full step, so lets try to get close
             mindist = 0
@@ -328,18 +929,26 @@ class ContinuousRobot(object):
             for i in range(EDGE_REFINEMENT_STEPS):
               # maxdist is too far, halfway
               p1 = self.robot.getNewPosition(self.robot.dir, (maxdist - mindist) * 1.0/2 + mindist)  # half step
-              if self.robot.room.isTileOccupied(p1):
+              if self.robot.blocked(p1):
                 mindist = (maxdist - mindist) * 1.0/2 + mindist
                 newpos = p1 # save better point
               else:
                 maxdist = (maxdist - mindist) * 1.0/2 + mindist
                 newpos = self.robot.getNewPosition(self.robot.dir, mindist)
+            if self.robot.fleet is not None and self.robot.fleet.collides(self.robot, newpos):
+              newpos = self.robot.pos  # Stay out of the other robot
             self.robot.pos = newpos
-            self.percepts = ('Bump',self.robot.room.isTileDirty(self.robot.pos))
+            self.percepts = BUMP_PERCEPTS[self.robot.room.isTileDirty(self.robot.pos)]
         
     def updatePositionAndClean(self):
         # use percepts set up during last action
-        self.runRobot()
+        profiler = self.robot.profiler
+        if profiler is not None and profiler.sampling:
+            start = profiler.clock()
+            self.runRobot()
+            profiler.child('runRobot', start, profiler.clock())
+        else:
+            self.runRobot()
         # Do actions ['TurnLeft','TurnRight','Forward','Reverse','Suck']
         # amt is degrees of turn in that direction of speed of forward 0..100
         (act, amt) = self.action
@@ -350,10 +959,22 @@ class ContinuousRobot(object):
         
         # perform action via dictionary lookup (hackerish way to reproduce case-statement)
         try:
-          self.actions[act](amt)
+          method = self.actions[act]
         except KeyError:
           raise ValueError("Unknown action: " + act)
+        method(amt)
         
+    def cycleState(self):
+      """ Used by runSimulation's cycle detection.  Return a hashable value
+          holding everything runRobot remembers between steps, or None if
+          the robot's choices aren't fully determined by its percepts and
+          that value (the default, unless reflex is set), which turns cycle
+          detection off.
+      """
+      if self.reflex:
+        return ()
+      return None
+
     def runRobot(self):
       """ User needs to fill in the function.
           Use class member variables to determine next action
@@ -361,17 +982,23 @@ class ContinuousRobot(object):
       """
       raise NotImplementedError       
       
+
 class DiscreteRobot(object):
     """ This class of robot lives in a discrete world where valid movement actions
     are North, South, East, and West.  Robot heading does not matter.  The Suck
     action will suck dirt from the current square. 
     Deterministic
     """
+    __slots__ = ('robot', 'percepts', 'actions', 'action')
+
+    # Heading of each movement action
+    MOVES = {'North': 0, 'South': 180, 'East': 90, 'West': 270}
+
     def __init__(self,room,speed, start_location = -1, chromosome = None):
         self.robot = RobotBase(room,speed, start_location)
         self.robot.centerInCell()
         # Valid percepts (['Bump',None],['Dirty',None])
-        self.percepts = (None,self.robot.room.isTileDirty(self.robot.pos) )
+        self.percepts = PERCEPTS[self.robot.room.isTileDirty(self.robot.pos)]
         self.actions = (None) 
         self.initialize(chromosome)
           # Valid actions ['North', 'South', 'East', 'West', 'Suck']
@@ -382,30 +1009,31 @@ class DiscreteRobot(object):
         
     def updatePositionAndClean(self):
         # use percepts set up during last action
-        self.runRobot()
+        profiler = self.robot.profiler
+        if profiler is not None and profiler.sampling:
+            start = profiler.clock()
+            self.runRobot()
+            profiler.child('runRobot', start, profiler.clock())
+        else:
+            self.runRobot()
         # Do actions ['North', 'South', 'East', 'West', 'Suck']
         (act) = self.action
+        robot = self.robot
         if act == 'Suck':
-            self.robot.room.cleanTileAtPosition(self.robot.pos)
-            self.percepts = (None,self.robot.room.isTileDirty(self.robot.pos))
+            robot.room.cleanTileAtPosition(robot.pos)
+            self.percepts = PERCEPTS[robot.room.isTileDirty(robot.pos)]
             return
-        elif act == 'North':
-            newpos = self.robot.getNewPosition(0, self.robot.speed)
-        elif act == 'South':
-            newpos = self.robot.getNewPosition(180, self.robot.speed)
-        elif act == 'East':
-            newpos = self.robot.getNewPosition(90, self.robot.speed)
-        elif act == 'West':
-            newpos = self.robot.getNewPosition(270, self.robot.speed)
-        else:
+        try:
+            newpos = robot.getNewPosition(self.MOVES[act], robot.speed)
+        except KeyError:
           raise ValueError("Unknown action: " + act)
-        if not self.robot.room.isTileOccupied(newpos) :
+        if not robot.blocked(newpos) :
           # Assume the floor is clear between here and there
-          self.robot.pos = newpos
-          self.percepts = (None,self.robot.room.isTileDirty(self.robot.pos))
+          robot.pos = newpos
+          self.percepts = PERCEPTS[robot.room.isTileDirty(newpos)]
         else:
           # Robot doesn't move
-          self.percepts = ('Bump',self.robot.room.isTileDirty(self.robot.pos))           
+          self.percepts = BUMP_PERCEPTS[robot.room.isTileDirty(robot.pos)]
         
     def runRobot(self):
       """ User needs to fill in the function.
@@ -413,6 +1041,59 @@ class DiscreteRobot(object):
           Place action in self.action
       """
       raise NotImplementedError
+
+    def cycleState(self):
+      """ Used by runSimulation's cycle detection, see
+          ContinuousRobot.cycleState.  Off by default.
+      """
+      return None
+
+    def getPlan(self):
+      """ Robots that already know every action they are going to take can
+          return them here, in order, and runSimulation will carry them out
+          without calling runRobot until the plan runs out or an action
+          bumps into a wall.  Return None (the default) otherwise.
+      """
+      return None
+
+    def planUsed(self, n):
+      """ Called after runSimulation carried out the first N actions of
+          getPlan(), so runRobot can carry on from there.
+      """
+
+    @classmethod
+    def planFleet(cls, robots):
+      """ Called by runSimulation once all the ROBOTS of a trial have been
+          made, before any of them moves, so they can split up the work.
+          Does nothing by default.
+      """
+
+    def followPlan(self, plan, goal, steps, limit = MAX_STEPS_IN_SIMULATION):
+      """ Carries out the actions of PLAN until the room has GOAL clean tiles,
+          the time reaches LIMIT, the plan runs out or a move would bump.
+          STEPS is the time so far; returns the new time.
+      """
+      robot = self.robot
+      room = robot.room
+      used = 0
+      for act in plan:
+        if goal <= room.getNumCleanTiles() or steps >= limit:
+          break
+        if act == 'Suck':
+          room.cleanTileAtPosition(robot.pos)
+        else:
+          if act not in self.MOVES:
+            break  # runRobot will report it
+          newpos = robot.getNewPosition(self.MOVES[act], robot.speed)
+          if robot.blocked(newpos):
+            break  # The plan went wrong, let runRobot deal with the bump
+          robot.pos = newpos
+        used += 1
+        steps += 1
+      if used:
+        self.percepts = PERCEPTS[room.isTileDirty(robot.pos)]
+        self.planUsed(used)
+      return steps
         
     def getRobotPosition(self):
       """ Return the position of the robot as a (x,y) tuple."""
@@ -447,10 +1128,12 @@ class RealisticRobot(ContinuousRobot):
     Introduces error when moving to simulate a slow motor and
     occasional loss of traction (hit a marble).
     """
-    def __init__(self, room, speed, chromosome = None):
+    __slots__ = ('lean',)
+
+    def __init__(self, room, speed, start_location = -1, chromosome = None):
       """ Use Robot's init, but set a left/right lean
       """
-      super(RealisticRobot, self).__init__(room, speed, chromosome = chromosome)
+      super(RealisticRobot, self).__init__(room, speed, start_location, chromosome)
       self.lean = random.random() * REALISTIC_LEAN_MAX * 2 - REALISTIC_LEAN_MAX
       
     def updatePositionAndClean(self):
@@ -461,32 +1144,265 @@ class RealisticRobot(ContinuousRobot):
       # Incorporate lean
       self.robot.dir = (self.robot.dir + self.lean) % 360
       # Simulate marble or dirt
-      if random.random() < REALISTIC_MARBLE_PROBABILITY:
-        self.robot.dir += random.random() * REALISTIC_MARBLE_MAX
+      rng = self.robot.rng or random
+      if rng.random() < REALISTIC_MARBLE_PROBABILITY:
+        self.robot.dir += rng.random() * REALISTIC_MARBLE_MAX
+
+    def cycleState(self):
+      """ Marbles make this robot random, so it never repeats for sure. """
+      return None
         
 
 
+class RunningStats(object):
+  """
+  Mean and standard deviation of a stream of numbers, kept up to date one
+  number at a time (Welford's method) without storing them.  Two of these can
+  be merged, e.g. to combine results from several processes.
+  """
+  def __init__(self, values = ()):
+    self.n = 0
+    self.mean = 0.0
+    self.m2 = 0.0  # sum of squared differences from the mean
+    for x in values:
+      self.add(x)
+
+  def add(self, x):
+    """ Adds the number X. """
+    self.n += 1
+    delta = x - self.mean
+    self.mean += delta / self.n
+    self.m2 += delta * (x - self.mean)
+
+  def merge(self, other):
+    """ Adds all the numbers another RunningStats has seen. """
+    if other.n == 0:
+      return
+    n = self.n + other.n
+    delta = other.mean - self.mean
+    self.mean += delta * other.n / n
+    self.m2 += other.m2 + delta * delta * self.n * other.n / n
+    self.n = n
+
+  def std(self):
+    """ Sample standard deviation, 0 with fewer than two numbers. """
+    if self.n < 2:
+      return 0.0
+    return math.sqrt(self.m2 / (self.n - 1))
+
+  def halfWidth(self, z):
+    """ Half the width of the normal confidence interval on the mean with
+    Z standard errors either side, e.g. 1.96 for 95%. """
+    if self.n == 0:
+      return float('inf')
+    return z * self.std() / math.sqrt(self.n)
+
+  def meanstdv(self):
+    """ (mean, std) in the same form as meanstdv(). """
+    if self.n == 0:
+      return 99,99
+    return self.mean, self.std()
+
+class QuantileSketch(object):
+  """
+  Approximate quantiles of a stream of non-negative numbers in constant
+  memory.  Numbers are counted in buckets whose bounds grow geometrically
+  (as in DDSketch), so any quantile is within SKETCH_ACCURACY of the true
+  value relative to it, and sketches from several processes can be merged by
+  adding their bucket counts.  Also counts how many numbers hit the limit of
+  MAX_STEPS_IN_SIMULATION.
+  """
+  def __init__(self, values = (), accuracy = SKETCH_ACCURACY):
+    self.gamma = (1 + accuracy) / (1 - accuracy)
+    self.logGamma = math.log(self.gamma)
+    self.buckets = {}  # bucket index -> count
+    self.zeros = 0
+    self.n = 0
+    self.timeouts = 0
+    self.min = None
+    self.max = None
+    for x in values:
+      self.add(x)
+
+  def add(self, x):
+    """ Adds the number X. """
+    self.n += 1
+    if x >= MAX_STEPS_IN_SIMULATION:
+      self.timeouts += 1
+    if self.min is None or x < self.min:
+      self.min = x
+    if self.max is None or x > self.max:
+      self.max = x
+    if x <= 0:
+      self.zeros += 1
+      return
+    i = int(math.ceil(math.log(x) / self.logGamma))
+    self.buckets[i] = self.buckets.get(i, 0) + 1
+
+  def merge(self, other):
+    """ Adds all the numbers another QuantileSketch with the same accuracy
+    has seen. """
+    if other.gamma != self.gamma:
+      raise ValueError("Can only merge sketches with the same accuracy")
+    for i, count in other.buckets.items():
+      self.buckets[i] = self.buckets.get(i, 0) + count
+    self.zeros += other.zeros
+    self.n += other.n
+    self.timeouts += other.timeouts
+    for x in (other.min, other.max):
+      if x is not None:
+        if self.min is None or x < self.min:
+          self.min = x
+        if self.max is None or x > self.max:
+          self.max = x
+
+  def quantile(self, q):
+    """ The approximate Q quantile (0 <= q <= 1), or None if empty. """
+    if self.n == 0:
+      return None
+    if q <= 0:
+      return self.min
+    if q >= 1:
+      return self.max
+    rank = q * (self.n - 1)
+    seen = self.zeros
+    if rank < seen:
+      return 0
+    for i in sorted(self.buckets):
+      seen += self.buckets[i]
+      if rank < seen:
+        value = 2 * self.gamma ** i / (self.gamma + 1)
+        return min(max(value, self.min), self.max)
+    return self.max
+
+  def timeoutRate(self):
+    """ Fraction of numbers that hit MAX_STEPS_IN_SIMULATION. """
+    if self.n == 0:
+      return 0.0
+    return self.timeouts / float(self.n)
+
+  def summary(self):
+    """ A one line summary: p50, p90, p99 and timeout rate. """
+    return "p50: %d p90: %d p99: %d timeouts: %.1f%%" % (
+        self.quantile(0.5), self.quantile(0.9), self.quantile(0.99),
+        100 * self.timeoutRate())
+
 def meanstdv(x):
   """
   Calculate mean and standard deviation of data x[]:
       mean = {\sum_i x_i \over n}
       std = sqrt(\sum_i (x_i - mean)^2 \over n-1)
+  in one pass.
   """
-  from math import sqrt
-  if len(x) == 0: 
-    return 99,99
-  elif len(x) == 1:
+  if len(x) == 1:
     return x[0],0
-  n, mean, std = len(x), 0, 0
-  for a in x:
-    mean = mean + a
-  mean = mean / float(n)
-  for a in x:
-    std = std + (a - mean)**2
-  std = sqrt(std / float(n-1))
-  return mean, std
+  return RunningStats(x).meanstdv()
+
+def confidenceZ(confidence):
+  """ Standard errors either side of the mean for a two sided normal
+  confidence interval, e.g. 1.96 for 0.95. """
+  from statistics import NormalDist
+  return NormalDist().inv_cdf((1 + confidence) / 2.0)
+
+def stopEarly(stats, ci_target = None, reference = None, min_trials = 3, z = 1.96):
+  """ The sequential stopping rule used by runSimulation.  True once at
+  least MIN_TRIALS have been run and either the confidence interval on the
+  mean is no wider than CI_TARGET either side, or the whole interval is above
+  (worse than) the REFERENCE score."""
+  if stats.n < max(min_trials, 2):
+    return False
+  half = stats.halfWidth(z)
+  if ci_target is not None and half <= ci_target:
+    return True
+  if reference is not None and stats.mean - half > reference:
+    return True
+  return False
+
+
+
+class StepList(list):
+  """ A sink for runSimulation that keeps the score of every trial, the
+  censored ones at their step budget, and counts the censored ones. """
+  censored = 0
+
+  def write(self, result):
+    self.append(result['score'])
+    if result['censored']:
+      self.censored += 1
+
+def stepBudget(max_steps = None):
+  """ The most time steps a trial may take: MAX_STEPS_IN_SIMULATION, or
+  MAX_STEPS if that is fewer.  A censored trial is scored as this. """
+  if max_steps is None:
+    return MAX_STEPS_IN_SIMULATION
+  return min(max_steps, MAX_STEPS_IN_SIMULATION)
+
+def streamSeed(seed, *key):
+  """ Seed of the random stream KEY (e.g. room, trial, robot) derived from
+  the master SEED.  Streams are independent of each other and of the order
+  they are used in, so any process can recreate any of them. """
+  return ':'.join(str(k) for k in (seed,) + key)
+
+def pairedDifference(a, b):
+  """ RunningStats of the trial by trial differences A[i] - B[i] between two
+  robots run on the same random numbers. """
+  stats = RunningStats()
+  for x, y in zip(a, b):
+    stats.add(x - y)
+  return stats
+
+def cycleFingerprint(robots):
+  """ Returns a hashable snapshot of the pose, percepts and cycleState() of
+  every robot, or None if any of them doesn't support cycle detection.
+  Poses are rounded to CYCLE_PRECISION places, since floating point error
+  keeps a looping robot from ever coming back to exactly the same spot, and
+  headings are taken mod 360 since turning never wraps them."""
+  states = []
+  for robot in robots:
+    state = robot.cycleState()
+    if state is None:
+      return None
+    x, y = robot.robot.pos
+    states.append((round(x, CYCLE_PRECISION), round(y, CYCLE_PRECISION),
+                   round(robot.robot.dir % 360, CYCLE_PRECISION) % 360,
+                   robot.percepts, state))
+  return tuple(states)
+
+class RoomPickler(pickle.Pickler):
+  """ Pickles robots without the room they point to. """
+  def __init__(self, f, room):
+    pickle.Pickler.__init__(self, f, pickle.HIGHEST_PROTOCOL)
+    self.room = room
+
+  def persistent_id(self, obj):
+    if self.room is not None and obj is self.room:
+      return 'room'
+    return None
 
+class RoomUnpickler(pickle.Unpickler):
+  """ Unpickles robots pickled by RoomPickler, pointing them at ROOM. """
+  def __init__(self, f, room):
+    pickle.Unpickler.__init__(self, f)
+    self.room = room
 
+  def persistent_load(self, pid):
+    if pid != 'room':
+      raise pickle.UnpicklingError("Unknown persistent id " + str(pid))
+    return self.room
+
+def writeCheckpoint(path, state, room = None):
+  """ Saves STATE, a dict, to PATH.  References to ROOM aren't saved, so pass
+  the same room to readCheckpoint.  The old checkpoint stays in place until
+  the new one is complete."""
+  tmp = '%s.%d.tmp' % (path, os.getpid())
+  with open(tmp, 'wb') as f:
+    RoomPickler(f, room).dump(state)
+  os.replace(tmp, path)
+
+def readCheckpoint(path, room = None):
+  """ Returns the state saved by writeCheckpoint. """
+  with open(path, 'rb') as f:
+    return RoomUnpickler(f, room).load()
 
 def runSimulation(robot_type, room, 
                   num_robots = 1, 
@@ -496,7 +1412,26 @@ def runSimulation(robot_type, room,
                   ui_enable = False, 
                   ui_delay = 0.2,
                   start_location = -1, 
-                  chromosome = None):
+                  chromosome = None,
+                  detect_cycles = False,
+                  checkpoint = None,
+                  checkpoint_steps = CHECKPOINT_STEPS,
+                  sinks = (),
+                  ci_target = None,
+                  reference = None,
+                  min_trials = 3,
+                  confidence = 0.95,
+                  stats = None,
+                  sketch = None,
+                  heatmap = None,
+                  profiler = None,
+                  robot_collisions = False,
+                  seed = None,
+                  room_number = 0,
+                  first_trial = 0,
+                  max_steps = None,
+                  trial_time = None,
+                  deadline = None):
     """
     Runs NUM_TRIALS trials of the simulation and returns the (mean, std) number of
     time-steps needed to clean the fraction min_clean of the room.
@@ -516,37 +1451,465 @@ def runSimulation(robot_type, room,
     start_location: (x,y) a pair representing the starting position of the robot
                 facing East.  Assumed to be in the environment.  
                 Default is random placement.
+    detect_cycles: set True to stop a trial as soon as deterministic robots
+                (see cycleState) are back in an earlier state without having
+                cleaned anything since.  They would loop forever, so the
+                trial is scored as running out of steps: censored at
+                max_steps if that is given, MAX_STEPS_IN_SIMULATION if not.
+                Ignored with the UI.
+    checkpoint: a file name.  If given, the finished trials, the random number
+                state and the robots and dirt of the current trial are saved
+                there after every trial and every CHECKPOINT_STEPS steps.  If
+                the file exists when runSimulation starts, it carries on from
+                there, exactly as if it had never stopped.  The file is removed
+                when all trials are done.  Robots must be picklable.
+    sinks: objects with a write(result) method, such as those in
+                roomba_metrics.py, that are given each trial result from
+                iterSimulation as soon as the trial is done.
+    ci_target, reference: make num_trials a maximum.  Trials stop once
+                min_trials are done and the CONFIDENCE interval on the mean
+                steps is within ci_target steps either side of it, or lies
+                wholly above the reference score.  See stopEarly.
+    stats: a RunningStats to add the steps of each trial to, if the caller
+                wants to know e.g. how many trials were run.
+    sketch: a QuantileSketch to add the steps of each trial to, for the
+                median, tail and timeout rate that mean and std hide.
+    heatmap: a roomba_metrics.TileHeatmap to record where robots go and when
+                each tile is first cleaned, see iterSimulation.
+    profiler: a roomba_metrics.PhaseProfiler to time the phases of the
+                simulation loop with, see iterSimulation.
+    robot_collisions: if True, robots bump into each other as well as into
+                walls, and get the 'Bump' percept when they do.  Robots are
+                ROBOT_SIZE tiles across and are found through a RobotIndex,
+                so large fleets stay fast.  They may start out overlapping.
+    seed, room_number: if a seed is given every trial is reproducible on its
+                own, whatever ran before it and in whichever process.  Each
+                robot is made, and so placed, from the random stream
+                (seed, room_number, trial, 'robot', robot number), draws its
+                noise (RealisticRobot's marbles) from the stream
+                (..., 'noise', robot number) and the agent programs share the
+                random module seeded from (..., 'agent').  Two robot types run
+                with the same seed meet the same starts and marbles.  The
+                random module's state is put back after each trial.
+    first_trial: number of the first trial, so a run can be split into
+                parts, e.g. trials 0-9 and 10-19, that use the same random
+                streams as running all the trials at once.
+    max_steps, trial_time: budgets for each trial, in time steps and in
+                seconds of wall-clock time.  A trial that runs out of either
+                before min_clean is reached is stopped and censored: it is
+                passed to the sinks with 'censored' set, and added to stats
+                and sketch as its step budget (see stepBudget), so stopping
+                trials early never makes a robot look better.  Without
+                max_steps a trial runs to MAX_STEPS_IN_SIMULATION and is
+                scored as that, as before.
+    deadline: a time.time() after which no more trials are started and the
+                trial running then is censored, to bound the whole run.
+    """
+    if stats is None:
+        stats = RunningStats()  # Results are summarized as they arrive
+    stopping = ci_target is not None or reference is not None
+    if stopping:
+        z = confidenceZ(confidence)
+    trials = iterSimulation(robot_type, room,
+                            num_robots = num_robots,
+                            speed = speed,
+                            min_clean = min_clean,
+                            num_trials = num_trials,
+                            ui_enable = ui_enable,
+                            ui_delay = ui_delay,
+                            start_location = start_location,
+                            chromosome = chromosome,
+                            detect_cycles = detect_cycles,
+                            checkpoint = checkpoint,
+                            checkpoint_steps = checkpoint_steps,
+                            heatmap = heatmap,
+                            profiler = profiler,
+                            robot_collisions = robot_collisions,
+                            seed = seed,
+                            room_number = room_number,
+                            first_trial = first_trial,
+                            max_steps = max_steps,
+                            trial_time = trial_time,
+                            deadline = deadline)
+    for result in trials:
+        stats.add(result['score'])
+        if sketch is not None:
+            sketch.add(result['score'])
+        for sink in sinks:
+            sink.write(result)
+        if stopping and stopEarly(stats, ci_target, reference, min_trials, z):
+            trials.close()
+            if checkpoint is not None and os.path.exists(checkpoint):
+                os.remove(checkpoint)
+            break
+    return stats.meanstdv()
+
+def iterSimulation(robot_type, room, 
+                   num_robots = 1, 
+                   speed = 1, 
+                   min_clean = 1.0, 
+                   num_trials = 1,
+                   ui_enable = False, 
+                   ui_delay = 0.2,
+                   start_location = -1, 
+                   chromosome = None,
+                   detect_cycles = False,
+                   checkpoint = None,
+                   checkpoint_steps = CHECKPOINT_STEPS,
+                   curve_steps = CURVE_STEPS,
+                   heatmap = None,
+                   profiler = None,
+                   robot_collisions = False,
+                   seed = None,
+                   room_number = 0,
+                   first_trial = 0,
+                   max_steps = None,
+                   trial_time = None,
+                   deadline = None):
+    """
+    Same as runSimulation, but a generator that yields a dict for each trial
+    as soon as it finishes, with keys
+      'trial': the trial number, from first_trial (default 0)
+      'steps': time-steps taken
+      'done':  True if min_clean of the room was cleaned within the limit
+      'censored': True if the trial was stopped by max_steps, trial_time or
+               deadline before it was done
+      'score': the number runSimulation averages: 'steps', or the step
+               budget (see stepBudget) if the trial was censored
+      'bumps': number of time-steps in which a robot bumped into something
+      'clean': the fraction of the room that was clean at time 0 and every
+               CURVE_STEPS (curve_steps) steps after, and at the end
+    When resuming from a checkpoint, the trials finished before are yielded
+    again first.  If the deadline stops the run early the checkpoint is kept,
+    so the remaining trials can be run later.
+    If HEATMAP (a roomba_metrics.TileHeatmap) is given, the tile under every
+    robot is counted after every step, and the step at which each tile is
+    cleaned is recorded.  Plans are then run one step at a time.
+    If PROFILER (a roomba_metrics.PhaseProfiler) is given, the phases of the
+    time steps it samples are timed and the steps and trials are counted.
     """
-    results = []  # store per trial results for later analysis
-    for trial in range(num_trials):
-        curroom = copy.deepcopy(room) # copy room since we change it
+    results = []  # trial results so far, only kept for checkpoints
+    resume = None
+    # The caller's random state, put back after each seeded trial
+    outer = random.getstate()
+    if checkpoint is not None:
+        # Enough to tell if a checkpoint belongs to some other simulation.
+        # Hashing the layout visits every tile, so only done when needed.
+        setup = (robot_type.__module__, robot_type.__name__, num_robots, speed,
+                 min_clean, num_trials, room.getWidth(), room.getHeight(),
+                 room.getNumTiles(), room.getNumCleanTiles(), seed, room_number,
+                 first_trial, max_steps, room.layoutDigest())
+    if checkpoint is not None and os.path.exists(checkpoint):
+        resume = readCheckpoint(checkpoint, room)
+        if resume['setup'] != setup:
+            raise ValueError("Checkpoint " + checkpoint + " is for a different simulation")
+        results = resume['results']
+        if seed is None or resume['robots'] is not None:
+            # Seeded trials start from their own streams
+            random.setstate(resume['random'])
+        if resume['robots'] is None:
+            resume = None
+        for result in results:
+            yield result
+    if ui_enable:
+        import roomba_visualize
+    if profiler is not None:
+        clock = profiler.clock
+    limit = stepBudget(max_steps)
+    for trial in range(first_trial + len(results), first_trial + num_trials):
+      if deadline is not None and time.time() >= deadline:
+          return  # Out of time, leave the rest of the trials to a later run
+      stopAt = deadline
+      if trial_time is not None:
+          stopAt = time.time() + trial_time
+          if deadline is not None:
+              stopAt = min(stopAt, deadline)
+      censored = False
+      # Rather than copying the room, undo whatever the robots clean
+      room.beginUndo()
+      try:
         if ui_enable:
-            anim = roomba_visualize.RobotVisualization(num_robots, curroom, delay=ui_delay, goal=min_clean)
-        robots = []
-        for i in range(num_robots):
-            robots.append(robot_type(curroom, speed, start_location, chromosome))
-        thisTime = 0
-        while min_clean * curroom.getNumTiles() > curroom.getNumCleanTiles() and thisTime < MAX_STEPS_IN_SIMULATION:
+            anim = roomba_visualize.RobotVisualization(num_robots, room, delay=ui_delay, goal=min_clean)
+        if resume is not None:
+            # Pick up the trial where the checkpoint left it
+            for pos in resume['cleaned']:
+                room.cleanTileAtPosition(pos)
+            robots = resume['robots']
+            fleet = robots[0].robot.fleet
+            thisTime = resume['time']
+            bumps = resume['bumps']
+            curve = resume['curve']
+            (cycles, saved, power, lam, lastClean) = resume['cycles']
+            resume = None
+        else:
+            outer = random.getstate()
+            robots = []
+            for i in range(num_robots):
+                if seed is not None:
+                    random.seed(streamSeed(seed, room_number, trial, 'robot', i))
+                robot = robot_type(room, speed, start_location, chromosome)
+                if seed is not None:
+                    robot.robot.rng = random.Random(streamSeed(seed, room_number, trial, 'noise', i))
+                robots.append(robot)
+            if seed is not None:
+                random.seed(streamSeed(seed, room_number, trial, 'agent'))
+            if hasattr(robot_type, 'planFleet'):
+                robot_type.planFleet(robots)
+            fleet = None
+            if robot_collisions:
+                fleet = RobotIndex()
+                for robot in robots:
+                    robot.robot.joinFleet(fleet)
+            thisTime = 0
+            bumps = 0
+            curve = [room.getNumCleanTiles() / float(room.getNumTiles())]
+            # Brent's cycle detection: compare against a saved state that is
+            # moved forward at powers of two, starting over whenever dirt is
+            # cleaned
+            cycles = detect_cycles and not ui_enable
+            saved, power, lam = None, 1, 0
+            lastClean = room.getNumCleanTiles()
+        if profiler is not None:
             for robot in robots:
-                robot.updatePositionAndClean()
+                robot.robot.profiler = profiler
+        goal = min_clean * room.getNumTiles()
+        numCleaned = len(room.undoLog)  # Tiles already passed to the heatmap
+        # Carry out a plan worked out in advance in one go
+        if (num_robots == 1 and not ui_enable and heatmap is None
+                and hasattr(robots[0], 'getPlan')):
+            plan = robots[0].getPlan()
+            if plan:
+                if profiler is not None:
+                    start = clock()
+                thisTime = robots[0].followPlan(plan, goal, thisTime, limit)
+                if profiler is not None:
+                    profiler.add('plan', start, clock())
+        while True:
+            sampled = profiler is not None and profiler.startStep(thisTime)
+            if sampled:
+                start = clock()
+            running = goal > room.getNumCleanTiles() and thisTime < limit
+            if sampled:
+                now = clock()
+                profiler.add('termination', start, now)
+                start = now
+            if not running:
+                # Ran out of steps, rather than cycling or quitting the UI
+                censored = max_steps is not None and goal > room.getNumCleanTiles()
+                break
+            if fleet is None:
+                for robot in robots:
+                    robot.updatePositionAndClean()
+            else:
+                for robot in robots:
+                    base = robot.robot
+                    oldpos = base.pos
+                    robot.updatePositionAndClean()
+                    if base.pos is not oldpos:
+                        fleet.move(base, oldpos)
+            if sampled:
+                now = clock()
+                profiler.add('physics', start, now)
+                start = now
             thisTime += 1
+            for robot in robots:
+                if robot.percepts[0] == 'Bump':
+                    bumps += 1
+                    break
+            if thisTime % curve_steps == 0:
+                curve.append(room.getNumCleanTiles() / float(room.getNumTiles()))
+            if heatmap is not None:
+                for robot in robots:
+                    heatmap.visit(robot.robot.pos)
+                if len(room.undoLog) > numCleaned:
+                    for tile in room.getCleaned(numCleaned):
+                        heatmap.cleaned(tile, thisTime)
+                    numCleaned = len(room.undoLog)
+            if cycles:
+              state = cycleFingerprint(robots)
+              clean = room.getNumCleanTiles()
+              if state is None:
+                cycles = False
+              elif clean != lastClean:
+                lastClean = clean
+                saved, power, lam = state, 1, 0
+              elif state == saved:
+                # Would never finish, so it is scored as running out of steps
+                thisTime = limit
+                censored = max_steps is not None
+                break
+              else:
+                lam += 1
+                if lam == power:
+                  saved, power, lam = state, power * 2, 0
+            if sampled:
+                now = clock()
+                profiler.add('bookkeeping', start, now)
+                start = now
             if ui_enable:
-                anim.update(curroom, robots)
+                anim.update(room, robots)
+                if sampled:
+                    now = clock()
+                    profiler.add('ui', start, now)
                 if anim.quit:
-                  results.append(thisTime)
-                  return meanstdv(results)
-        results.append(thisTime)
+                  break
+            if checkpoint is not None and thisTime % checkpoint_steps == 0:
+                writeCheckpoint(checkpoint, {'setup': setup,
+                                             'results': results,
+                                             'random': random.getstate(),
+                                             'robots': robots,
+                                             'time': thisTime,
+                                             'bumps': bumps,
+                                             'curve': curve,
+                                             'cleaned': room.getCleaned(),
+                                             'cycles': (cycles, saved, power, lam, lastClean)},
+                                room)
+            if stopAt is not None and thisTime % CLOCK_STEPS == 0 and time.time() >= stopAt:
+                censored = True
+                break
+        if thisTime % curve_steps != 0:
+            curve.append(room.getNumCleanTiles() / float(room.getNumTiles()))
+        if heatmap is not None:
+            heatmap.endTrial()
+        if profiler is not None:
+            profiler.sampling = False
+            profiler.count('steps', thisTime)
+            profiler.count('trials')
+        result = {'trial': trial,
+                  'steps': thisTime,
+                  'done': goal <= room.getNumCleanTiles(),
+                  'bumps': bumps,
+                  'clean': curve,
+                  'censored': censored,
+                  'score': limit if censored else thisTime}
+        if checkpoint is not None:
+            results.append(result)
+            writeCheckpoint(checkpoint, {'setup': setup, 'results': results,
+                                         'random': random.getstate(), 'robots': None})
+        if ui_enable and anim.quit:
+            yield result
+            return
         if ui_enable:
             anim.done()
-    return meanstdv(results)
+      finally:
+        room.restoreDirt()
+        if seed is not None:
+            random.setstate(outer)
+      yield result
+    if checkpoint is not None and os.path.exists(checkpoint):
+        os.remove(checkpoint)
     
-def testAllMaps(robot, rooms, numtrials = 10, start_location = -1, chromosome = None):
+def testAllMaps(robot, rooms, numtrials = 10, start_location = -1, chromosome = None,
+                detect_cycles = False, checkpoint = None, ci_target = None,
+                reference = None, min_trials = 3, confidence = 0.95,
+                profiler = None, seed = None, compare_to = None):
   """ Runs the specified robot over the list of rooms, optionally with a specified
   number of trials per map, and starting location (x,y).
   Prints status to the screen and returns the average performance over all maps and 
-  trials."""
+  trials.
+  If a checkpoint file name is given, finished rooms are recorded there and
+  each room's runSimulation checkpoints to checkpoint + '.<room number>', so
+  an interrupted call picks up where it left off when run again.
+  With ci_target or reference (a score, or a list of scores, one per room)
+  numtrials is a maximum, and each room stops as soon as runSimulation's
+  stopping rule is met.
+  With a roomba_metrics.PhaseProfiler, every room is profiled and the time
+  spent in each phase of a step is printed at the end.
+  With a seed, room i is run as runSimulation(seed = seed, room_number = i),
+  so results are reproducible room by room.  With another robot type as
+  compare_to, that robot is run on the same rooms, trials and random numbers
+  (common random numbers), and the mean trial by trial difference in score
+  is printed with its confidence interval.  Pairing cancels most of the
+  noise the two robots share, so far fewer trials tell them apart."""
   score = 0
-  for room in rooms:
+  total_trials = 0
+  done = {}  # room number -> (score, std, trials) of rooms finished before a restart
+  if compare_to is not None:
+    if seed is None:
+      seed = random.getrandbits(32)
+    z = confidenceZ(confidence)
+    paired = RunningStats()
+  if checkpoint is not None and os.path.exists(checkpoint):
+    state = readCheckpoint(checkpoint)
+    done = state['done']
+    random.setstate(state['random'])
+  for i, room in enumerate(rooms):
+    if i in done:
+      runscore, runstd, trials = done[i]
+    else:
+      if isinstance(reference, (list, tuple)):
+        roomreference = reference[i]
+      else:
+        roomreference = reference
+      stats = RunningStats()
+      steps = StepList()
+      runscore, runstd = runSimulation(num_robots = 1,
+                      speed = 1,
+                      min_clean = 0.95,
+                      num_trials = numtrials,
+                      room = room,
+                      robot_type = robot,
+                      start_location = start_location,
+                      #debug = True,
+                      chromosome = chromosome,
+                      detect_cycles = detect_cycles,
+                      checkpoint = None if checkpoint is None else '%s.%d' % (checkpoint, i),
+                      ci_target = ci_target,
+                      reference = roomreference,
+                      min_trials = min_trials,
+                      confidence = confidence,
+                      stats = stats,
+                      profiler = profiler,
+                      seed = seed,
+                      room_number = i,
+                      sinks = [steps],
+                      ui_enable = False)
+      trials = stats.n
+    score += runscore
+    total_trials += trials
+    if trials != numtrials:
+      print("Room %d of %d done (score: %d std: %d) after %d trials" % (i+1, len(rooms), runscore, runstd, trials))
+    else:
+      print("Room %d of %d done (score: %d std: %d)" % (i+1, len(rooms), runscore, runstd))
+    if compare_to is not None and i not in done:
+      othersteps = StepList()
+      runSimulation(num_robots = 1,
+                    speed = 1,
+                    min_clean = 0.95,
+                    num_trials = trials,
+                    room = room,
+                    robot_type = compare_to,
+                    start_location = start_location,
+                    chromosome = chromosome,
+                    detect_cycles = detect_cycles,
+                    seed = seed,
+                    room_number = i,
+                    sinks = [othersteps],
+                    ui_enable = False)
+      diff = pairedDifference(steps, othersteps)
+      paired.merge(diff)
+      print("  vs %s: %+.1f +- %.1f" % (compare_to.__name__, diff.mean, diff.halfWidth(z)))
+    if checkpoint is not None and i not in done:
+      done[i] = (runscore, runstd, trials)
+      writeCheckpoint(checkpoint, {'done': done, 'random': random.getstate()})
+  print("Average score over %d trials: %d" % (total_trials, score / len(rooms)))
+  if compare_to is not None:
+    print("Paired difference vs %s over %d trials: %+.1f +- %.1f (%d%% confidence)" %
+          (compare_to.__name__, paired.n, paired.mean, paired.halfWidth(z), confidence * 100))
+  if profiler is not None:
+    print(profiler.summary())
+  if checkpoint is not None and os.path.exists(checkpoint):
+    os.remove(checkpoint)
+  return score / len(rooms)
+  
+def measureStepRate(robot, rooms, numtrials = 1, start_location = -1, chromosome = None):
+  """ Runs the specified robot over the list of rooms like testAllMaps, but
+  prints how many simulation steps per second each room ran at, including
+  robot setup.  Returns the overall steps per second."""
+  total_steps = 0
+  total_time = 0.0
+  for i, room in enumerate(rooms):
+    starttime = time.time()
     runscore, runstd = runSimulation(num_robots = 1,
                     speed = 1,
                     min_clean = 0.95,
@@ -554,14 +1917,18 @@ def testAllMaps(robot, rooms, numtrials = 10, start_location = -1, chromosome =
                     room = room,
                     robot_type = robot,
                     start_location = start_location,
-                    #debug = True,
                     chromosome = chromosome,
                     ui_enable = False)
-    score += runscore
-    print("Room %d of %d done (score: %d std: %d)" % (rooms.index(room)+1, len(rooms), runscore, runstd))
-  print("Average score over %d trials: %d" % (numtrials * len(rooms), score / len(rooms)))
-  return score / len(rooms)
-  
+    elapsed = time.time() - starttime
+    steps = runscore * numtrials
+    total_steps += steps
+    total_time += elapsed
+    print("Room %d of %d: %d steps in %.3f s (%d steps/s)" %
+          (i + 1, len(rooms), steps, elapsed, steps / max(elapsed, 1e-9)))
+  rate = total_steps / max(total_time, 1e-9)
+  print("Overall: %d steps/s" % rate)
+  return rate
+
 # Print text if this file was run on its own.  
 if __name__ == "__main__":
    print("No example robots implemented.  See H1.py for examples of usage.")